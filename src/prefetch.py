@@ -1,16 +1,653 @@
 import collections
+import functools
+import itertools
+import numbers
+import operator
+import threading
 import time
+import uuid
+import weakref
+from contextlib import contextmanager
 from logging import getLogger
 
 import django
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.exceptions import FieldDoesNotExist
+from django.db import DEFAULT_DB_ALIAS
+from django.db import connections
 from django.db import models
+from django.db import transaction
+from django.db.models import Expression
+from django.db.models import F
+from django.db.models import OuterRef
+from django.db.models import Subquery
+from django.db.models import Value
 from django.db.models import query
+from django.db.models import signals
 from django.db.models.fields.related_descriptors import ForwardManyToOneDescriptor
+from django.dispatch import Signal
+
+try:
+    from concurrent.futures import Future
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # Python 2 without the futures backport
+    Future = ThreadPoolExecutor = None
+
+try:
+    from asgiref.local import Local
+except ImportError:  # Django < 3.0
+    from threading import local as Local
+
+try:
+    from django.utils.asyncio import async_unsafe
+except ImportError:  # Django < 3.0
+    def async_unsafe(message):
+        return lambda func: func
+
+try:
+    from django.db.models import Window
+    from django.db.models.functions import RowNumber
+except ImportError:  # Django < 2.0
+    Window = RowNumber = None
 
 __version__ = '1.2.3'
 
 logger = getLogger(__name__)
 
+try:
+    clock = time.perf_counter
+except AttributeError:  # Python 2
+    clock = time.time
+
+#: Sent after every prefetcher ran, with the model of the queryset as sender and these arguments: ``prefetcher``,
+#: ``name``, ``parents`` (number of objects), ``keys``, ``related`` (number of related objects), ``mapping_time``,
+#: ``query_time`` and ``decorate_time`` (in seconds). Prefetchers sharing a source report the same query.
+prefetched = Signal()
+
+
+def is_prefetcher_instance(prefetcher):
+    """
+    Prefetch definitions are either ready to use instances (of ``Prefetcher`` or ``ReverseFK``) or classes that get
+    instantiated, with the options, in every prefetch call.
+    """
+    return prefetcher.__class__ is Prefetcher or isinstance(prefetcher, ReverseFK)
+
+
+@contextmanager
+def logged_failure(name, model):
+    try:
+        yield
+    except Exception:
+        logger.exception("Prefetch failed for %s prefetch on the %s model:", name, model.__name__)
+        raise
+
+
+def timed_query(prefetcher, keys, name, model, db, nested, cache):
+    start = clock()
+    related_data = prefetcher.query(keys, name, model, db, nested, cache)
+    return related_data, clock() - start
+
+
+def workers_unusable():
+    # Worker threads have their own connections: they can't see the data of the transaction (and on SQLite they
+    # would wait for its locks), nor in-memory SQLite databases that can't be shared (on Python 2).
+    return any(
+        connection.in_atomic_block or (
+            connection.vendor == 'sqlite' and connection.is_in_memory_db() and
+            not getattr(connection.features, 'can_share_in_memory_db', True)
+        )
+        for connection in connections.all()
+    )
+
+
+def query_worker(tasks, model, db, cache, budgets):
+    """
+    Runs the queries of the ``(future, group)`` tasks, in a worker thread, until there are none left. Connections
+    are per thread, the ones the worker opened are closed once it's done.
+    """
+    try:
+        while True:
+            try:
+                future, group = tasks.popleft()
+            except IndexError:
+                return
+            leader = group[0]
+            try:
+                with QueryBudget.counting(budgets):
+                    future.set_result(timed_query(leader.prefetcher, get_group_keys(group), leader.name, model, db,
+                                                  leader.nested, cache))
+            except Exception as exc:
+                future.set_exception(exc)
+    finally:
+        connections.close_all()
+
+
+def start_query_workers(executor, workers, groups, model, db, cache, budgets):
+    """
+    Runs the queries of ``groups`` in ``workers`` threads of ``executor``. Returns a future for every group.
+    """
+    tasks = collections.deque((Future(), group) for group in groups)
+    futures = [future for future, _ in tasks]
+    for _ in range(workers):
+        executor.submit(query_worker, tasks, model, db, cache, budgets)
+    return futures
+
+
+def query_in_thread(prefetcher, keys, name, model, db, nested, cache, budgets):
+    try:
+        with QueryBudget.counting(budgets):
+            return timed_query(prefetcher, keys, name, model, db, nested, cache)
+    finally:
+        # Connections are per-thread, don't leave the ones opened by the worker behind.
+        connections.close_all()
+
+
+PlannedPrefetch = collections.namedtuple('PlannedPrefetch', [
+    'name', 'forwarders', 'prefetcher', 'nested', 'data_mapping', 'parents', 'mapping_time'
+])
+
+
+def check_nested(prefetcher, nested, related_data=None):
+    if prefetcher.fields:
+        raise InvalidPrefetch("Invalid nested prefetch call with %s on %r. Nested prefetches need model "
+                              "instances, they cannot be used with fields." % (
+                                  ', '.join(getattr(i, 'name', i) for i in nested), prefetcher))
+    if related_data is not None and not isinstance(related_data, PrefetchQuerySet):
+        raise InvalidPrefetch("Invalid nested prefetch call with %s on %r. The filter needs to return a "
+                              "PrefetchQuerySet." % (', '.join(getattr(i, 'name', i) for i in nested), prefetcher))
+
+
+def get_source_key(model, forwarders, prefetcher, nested):
+    """
+    Prefetchers with the same source key share a query: they have the same source and fields and are defined on the
+    same model (the one at the end of the forwarders), for the same objects.
+    """
+    if prefetcher.source is None or nested:
+        return None
+    for field in forwarders:
+        model = model._meta.get_field(field).related_model
+    return model, tuple(forwarders), prefetcher.source, prefetcher.fields
+
+
+def get_group_keys(group):
+    if len(group) == 1:
+        return group[0].data_mapping.keys()
+    return collections.OrderedDict.fromkeys(itertools.chain.from_iterable(
+        planned.data_mapping for planned in group
+    )).keys()
+
+
+def get_union_ordering(queryset):
+    """
+    Returns the ordering of ``queryset`` if it can be part of a ``UNION ALL`` query (see ``union_all``), otherwise
+    ``None``. Only plain querysets of model instances qualify, ordered by fields of the model. The combined query
+    only keeps the state of the first queryset, so the ones with prefetches don't.
+    """
+    if not isinstance(queryset, query.QuerySet) or not issubclass(queryset._iterable_class, query.ModelIterable):
+        return None
+    if getattr(queryset, '_prefetch', None) or queryset._prefetch_related_lookups or queryset._known_related_objects:
+        return None
+    sql = queryset.query
+    if sql.combinator or sql.distinct or sql.low_mark or sql.high_mark is not None or sql.annotations or sql.extra or \
+            sql.select_related or sql.select_for_update or sql.deferred_loading != (frozenset(), True):
+        return None
+    ordering = sql.order_by or (sql.default_ordering and queryset.model._meta.ordering) or ()
+    for name in ordering:
+        if not isinstance(name, str):
+            return None
+        try:
+            field = queryset.model._meta.get_field(name.lstrip('-'))
+        except FieldDoesNotExist:
+            return None
+        if not field.concrete or field.is_relation:
+            return None
+    return tuple(ordering)
+
+
+def union_all(querysets):
+    """
+    Runs ``querysets`` (of the same model, with the same ordering) in a single ``UNION ALL`` query and returns the
+    list of objects of every queryset, and the time it took. The rows are told apart with an extra column.
+    """
+    start = clock()
+    ordering = get_union_ordering(querysets[0])
+    parts = [
+        queryset.annotate(prefetch_union_index=Value(index, output_field=models.IntegerField())).order_by()
+        for index, queryset in enumerate(querysets)
+    ]
+    results = [[] for _ in querysets]
+    for obj in parts[0].union(*parts[1:], all=True).order_by('prefetch_union_index', *ordering):
+        results[obj.__dict__.pop('prefetch_union_index')].append(obj)
+    return results, clock() - start
+
+
+def decorate_group(group, get_related_data, model):
+    with logged_failure(group[0].name, model):
+        related_data, query_time = get_related_data()
+    for planned in group:
+        with logged_failure(planned.name, model):
+            start = clock()
+            planned.prefetcher.decorate(planned.data_mapping, related_data, planned.name, model, planned.forwarders)
+            send_prefetched(planned.prefetcher, planned.name, model, planned.parents, planned.data_mapping,
+                            related_data, planned.mapping_time, query_time, clock() - start)
+
+
+def send_prefetched(prefetcher, name, model, parents, data_mapping, related_data, mapping_time, query_time,
+                    decorate_time):
+    logger.debug("Prefetched %s related objects for %s keys of %s %s objects with the %s prefetcher, in %.3f secs "
+                 "(mapping %.3f, query %.3f, decorating %.3f).", len(related_data), len(data_mapping), parents,
+                 model.__name__, name, mapping_time + query_time + decorate_time, mapping_time, query_time,
+                 decorate_time)
+    prefetched.send(
+        sender=model, prefetcher=prefetcher, name=name, parents=parents, keys=len(data_mapping),
+        related=len(related_data), mapping_time=mapping_time, query_time=query_time, decorate_time=decorate_time,
+    )
+
+
+def describe_option(option):
+    if not isinstance(option, PrefetchOption):
+        return option
+    arguments = [repr(arg) for arg in option.args]
+    arguments.extend('%s=%r' % item for item in sorted(option.kwargs.items()))
+    return '%s(%s)' % (option.name, ', '.join(arguments))
+
+
+def get_satisfied_marker(name, prefetcher, nested):
+    # Only names and reprs, the instances must stay picklable (and the prefetchers aren't).
+    return name, getattr(prefetcher, 'prefetch_option', None), tuple(describe_option(option) for option in nested)
+
+
+def get_satisfied(obj, forwarders):
+    for field in forwarders:
+        obj = getattr(obj, field, None)
+    return getattr(obj, '_prefetch_satisfied', ())
+
+
+def mark_satisfied(obj, forwarders, prefetch):
+    for field in forwarders:
+        obj = getattr(obj, field, None)
+    if obj is not None:
+        obj.__dict__.setdefault('_prefetch_satisfied', set()).add(prefetch)
+
+
+class RelatedData(list):
+    """
+    The related objects of ``keys`` put together from the cached entries of every key. The objects related to
+    several keys are only listed once, so the relation mapping can't be rebuilt from the list: the entries are kept
+    as the relation mapping of ``prefetcher``.
+    """
+
+    def __init__(self, prefetcher, keys, entries):
+        related_data = collections.OrderedDict()
+        for key in keys:
+            for obj in entries[key]:
+                if isinstance(obj, models.Model) and obj.pk is not None:
+                    related_data[obj.__class__, obj.pk] = obj
+                else:
+                    related_data[id(obj)] = obj
+        super(RelatedData, self).__init__(related_data.values())
+        self.prefetcher = prefetcher
+        self.relation_mapping = dict((key, entries[key]) for key in keys if entries[key])
+
+
+def share_related_instances(data):
+    # Every row got its own instances of the related objects (from select_related and the forwarders), keep only the
+    # first instance of every row and put it everywhere.
+    identity = {}
+    pending = []
+    for obj in data:
+        if identity.setdefault((obj.__class__, obj.pk), obj) is obj:
+            pending.append(obj)
+    while pending:
+        cache = pending.pop()._state.fields_cache
+        for field, related in list(cache.items()):
+            if not isinstance(related, models.Model) or related.pk is None:
+                continue
+            shared = identity.setdefault((related.__class__, related.pk), related)
+            if shared is related:
+                pending.append(related)
+            else:
+                cache[field] = shared
+
+
+class KeyTable(Expression):
+    """
+    Subquery selecting ``keys``, given to ``Prefetcher.filter`` instead of the list of keys when there are more than
+    ``key_table_threshold`` of them. On PostgreSQL the keys are sent as a single array parameter, on SQLite and MySQL
+    they're loaded in a temporary table (see ``loaded``). Only integer and string keys are supported.
+    """
+    vendors = 'postgresql', 'sqlite', 'mysql'
+
+    def __init__(self, keys):
+        super(KeyTable, self).__init__()
+        self.keys = list(keys)
+        self.name = 'prefetch_keys_%s' % uuid.uuid4().hex
+
+    def as_sql(self, compiler, connection):
+        if connection.vendor == 'postgresql':
+            sql, params = 'SELECT unnest(%s)', [self.keys]
+        else:
+            sql, params = 'SELECT prefetch_key FROM %s' % connection.ops.quote_name(self.name), []
+        if django.VERSION >= (3, 0):
+            # Older versions always wrap the right hand side of the lookups in parentheses, twice would make it a
+            # scalar subquery.
+            sql = '(%s)' % sql
+        return sql, params
+
+    @contextmanager
+    def loaded(self, connection):
+        if connection.vendor == 'postgresql':
+            yield
+            return
+        table = connection.ops.quote_name(self.name)
+        if all(isinstance(key, numbers.Integral) for key in self.keys):
+            column_type = connection.data_types['BigIntegerField']
+        else:
+            column_type = connection.data_types['TextField']
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('CREATE TEMPORARY TABLE %s (prefetch_key %s)' % (table, column_type))
+                cursor.executemany('INSERT INTO %s (prefetch_key) VALUES (%%s)' % table, [(key,) for key in self.keys])
+            yield
+        finally:
+            # IF EXISTS, the CREATE might be what failed.
+            with connection.cursor() as cursor:
+                cursor.execute('DROP %sTABLE IF EXISTS %s' % ('TEMPORARY ' if connection.vendor == 'mysql' else '',
+                                                              table))
+
+
+def get_cache_version(cache, prefix):
+    # Invalidating changes the version instead of deleting all the keys. It's random so a version that got evicted
+    # from the cache can't come back.
+    version_key = 'prefetch:%s:version' % prefix
+    version = cache.get(version_key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(version_key, version, None):
+            version = cache.get(version_key, version)
+    return version
+
+
+def bump_cache_version(alias, prefix):
+    caches[alias].set('prefetch:%s:version' % prefix, uuid.uuid4().hex, None)
+
+
+def invalidate_cache(alias, prefix, sender=None, action='post_', using=None, **kwargs):
+    if action.startswith('post_'):
+        # Only once the changes are visible, otherwise a concurrent reader could cache the old rows under the new
+        # version.
+        transaction.on_commit(functools.partial(bump_cache_version, alias, prefix), using=using)
+
+
+def connect_cache_invalidation(prefetcher):
+    """
+    Connects the signals that invalidate the cached data of a prefetcher (instance or class) that has a
+    ``cache_alias``.
+    """
+    if not prefetcher.cache_alias:
+        return
+    if not prefetcher.cache_prefix:
+        raise RuntimeError("You must define a cache_prefix if you use a cache_alias")
+    if not prefetcher.cache_models:
+        raise RuntimeError("You must define the cache_models that invalidate the cache if you use a cache_alias")
+    receiver = functools.partial(invalidate_cache, prefetcher.cache_alias, prefetcher.cache_prefix)
+    for model in prefetcher.cache_models:
+        for signal in (signals.post_save, signals.post_delete, signals.m2m_changed):
+            signal.connect(receiver, sender=model, weak=False,
+                           dispatch_uid=('prefetch', prefetcher.cache_alias, prefetcher.cache_prefix))
+
+
+class LazyPrefetch(object):
+    """
+    Runs a prefetcher on the objects of a lazily prefetched result, only once.
+    """
+
+    def __init__(self, prefetcher, data, name, model, forwarders, db, nested):
+        self.prefetcher = prefetcher
+        self.data = data
+        self.args = name, model, forwarders, db, nested
+
+    @async_unsafe("Lazily prefetched attributes can't be loaded from async code, their queries would block the event "
+                  "loop. Don't use prefetch_lazy() there, or load the attribute with sync_to_async.")
+    def __call__(self):
+        if self.data is not None:
+            data, self.data = self.data, None
+            self.prefetcher.fetch(data, *self.args)
+
+
+# The pending loaders of the lazily prefetched objects, by id(obj). They are kept out of the instances so these can
+# still be pickled (a pickled copy just doesn't get the lazy data).
+lazy_loaders = {}
+
+
+def get_lazy_loaders(obj, create=False):
+    entry = lazy_loaders.get(id(obj))
+    if entry is not None and entry[0]() is obj:
+        return entry[1]
+    if not create:
+        return {}
+    key = id(obj)
+
+    def discard(ref, loaders=lazy_loaders):
+        # The module globals might be gone already if this runs at interpreter shutdown (on Python 2).
+        if loaders.get(key, (None,))[0] is ref:
+            del loaders[key]
+
+    pending = {}
+    lazy_loaders[key] = weakref.ref(obj, discard), pending
+    return pending
+
+
+class LazyPrefetchAttribute(object):
+    """
+    Descriptor installed on the models for the attributes of lazy prefetches. The attributes the decorators set on
+    the objects take precedence, so this only runs until the prefetcher runs (or forever on objects that were not
+    prefetched lazily, where it raises ``AttributeError``).
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        pending = get_lazy_loaders(instance)
+        loader = pending.get(self.name)
+        if loader is not None:
+            loader()
+            pending.pop(self.name, None)
+            if self.name in instance.__dict__:
+                return instance.__dict__[self.name]
+        detector = MissingPrefetchDetector.current()
+        if detector is not None:
+            detector.add_miss(instance, self.name)
+        raise AttributeError("%r object has no attribute %r" % (owner.__name__, self.name))
+
+    temporary = False
+
+    @classmethod
+    def install(cls, model, attrs, strict=True):
+        """
+        Installs the missing descriptors and returns their names. Non-``strict`` installs (for
+        ``MissingPrefetchDetector``) are temporary, unless a lazy prefetch needs the descriptor meanwhile.
+        """
+        installed = []
+        for attr in attrs:
+            if not hasattr(model, attr):
+                descriptor = cls(attr)
+                descriptor.temporary = not strict
+                setattr(model, attr, descriptor)
+                installed.append(attr)
+            elif isinstance(getattr(model, attr), cls):
+                if strict:
+                    getattr(model, attr).temporary = False
+            elif strict:
+                raise InvalidPrefetch("Cannot prefetch %s lazily on model %s, the class already has this "
+                                      "attribute." % (attr, model))
+        return installed
+
+    @classmethod
+    def uninstall(cls, model, attrs):
+        for attr in attrs:
+            descriptor = model.__dict__.get(attr)
+            if isinstance(descriptor, cls) and descriptor.temporary:
+                delattr(model, attr)
+
+
+class MissingPrefetch(Exception):
+    pass
+
+
+class MissingPrefetchDetector(object):
+    """
+    Detects the "1+N queries" problem for the prefetchers that have ``attrs``: inside the ``with`` block, it counts
+    the objects on which code looked for one of these attributes and didn't find it (the fallback path, when the
+    ``prefetch()`` call was forgotten). When the block ends, every prefetch that was missing on at least
+    ``threshold`` objects is reported: ``MissingPrefetch`` is raised, or a warning is logged if ``raise_errors`` is
+    false. Eg, in a test::
+
+        with MissingPrefetchDetector():
+            response = client.get('/authors/')
+
+    Only attributes that the model class doesn't already have are watched. The model classes are patched for the
+    duration of the block, so the detector is meant for tests.
+    """
+    local = Local()
+
+    def __init__(self, threshold=2, raise_errors=True):
+        self.threshold = threshold
+        self.raise_errors = raise_errors
+        self.definitions = {}
+        self.misses = collections.defaultdict(set)
+        self.installed = []
+
+    @classmethod
+    def current(cls):
+        stack = getattr(cls.local, 'stack', ())
+        return stack[-1] if stack else None
+
+    def __enter__(self):
+        for model in apps.get_models():
+            for manager in model._meta.managers:
+                if not isinstance(manager, PrefetchManagerMixin):
+                    continue
+                for name, definition in manager.prefetch_definitions.items():
+                    attrs = definition.attrs
+                    if isinstance(attrs, property):
+                        try:
+                            attrs = attrs.fget(definition)
+                        except AttributeError:
+                            continue
+                    self.installed.append((model, LazyPrefetchAttribute.install(model, attrs, strict=False)))
+                    for attr in attrs:
+                        self.definitions.setdefault((model, attr), name)
+
+        self.local.stack = getattr(self.local, 'stack', ()) + (self,)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.local.stack = tuple(i for i in self.local.stack if i is not self)
+        for model, attrs in self.installed:
+            LazyPrefetchAttribute.uninstall(model, attrs)
+        self.installed = []
+        missing = self.get_missing()
+        if not missing or exc_type is not None:
+            return
+        message = "Missing prefetches: %s" % ', '.join(
+            "%s.objects.prefetch(%r) (used on %s objects)" % (model.__name__, name, count)
+            for (model, name), count in missing.items()
+        )
+        if self.raise_errors:
+            raise MissingPrefetch(message)
+        logger.warning(message)
+
+    def add_miss(self, instance, attr):
+        name = self.definitions.get((instance.__class__, attr))
+        if name is not None:
+            self.misses[instance.__class__, name].add(id(instance))
+
+    def get_missing(self):
+        return collections.OrderedDict(
+            (key, len(instances)) for key, instances in self.misses.items() if len(instances) >= self.threshold
+        )
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryBudget(object):
+    """
+    Counts the queries made inside the ``with`` block, on all the databases, including the ones the prefetchers make
+    in worker threads (see ``prefetch_workers``). When the block ends ``QueryBudgetExceeded`` is raised if there were
+    more than ``limit`` queries, with the list of queries in the message. Eg, in a test::
+
+        with QueryBudget(3):
+            authors = list(Author.objects.prefetch('books', 'latest_book'))
+
+    Also see ``PrefetchQuerySet.expect_queries``. Requires Django 2.0 or later. In async code the budget only
+    applies to the current task.
+    """
+    local = Local()
+
+    def __init__(self, limit, description=None):
+        if limit < 0:
+            raise ValueError('The query budget must be positive.')
+        self.limit = limit
+        self.description = description
+        self.queries = []
+        self.lock = threading.Lock()
+
+    @classmethod
+    def current(cls):
+        return getattr(cls.local, 'stack', ())
+
+    @classmethod
+    @contextmanager
+    def counting(cls, budgets):
+        """
+        Counts the queries made in the current thread for the given budgets (without checking them).
+        """
+        installed = []
+        try:
+            for connection in connections.all() if budgets else ():
+                if not hasattr(connection, 'execute_wrappers'):
+                    raise RuntimeError("Query budgets require Django 2.0 or later.")
+                for budget in budgets:
+                    connection.execute_wrappers.append(budget.record)
+                    installed.append((connection, budget.record))
+            yield
+        finally:
+            for connection, wrapper in installed:
+                connection.execute_wrappers.remove(wrapper)
+
+    def record(self, execute, sql, params, many, context):
+        with self.lock:
+            self.queries.append(sql)
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self.counter = self.counting([self])
+        self.counter.__enter__()
+        self.local.stack = getattr(self.local, 'stack', ()) + (self,)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.local.stack = tuple(i for i in self.local.stack if i is not self)
+        self.counter.__exit__(exc_type, exc_value, tb)
+        if exc_type is None:
+            self.check()
+
+    def check(self):
+        if len(self.queries) > self.limit:
+            raise QueryBudgetExceeded("%s made %s queries, expected at most %s:\n%s" % (
+                self.description or 'Block', len(self.queries), self.limit,
+                '\n'.join('%s. %s' % (i, sql) for i, sql in enumerate(self.queries, 1))
+            ))
+
 
 class PrefetchManagerMixin(models.Manager):
     use_for_related_fields = True
@@ -23,8 +660,9 @@ class PrefetchManagerMixin(models.Manager):
     def __init__(self):
         super(PrefetchManagerMixin, self).__init__()
         for name, prefetcher in self.prefetch_definitions.items():
-            if prefetcher.__class__ is not Prefetcher and not callable(prefetcher):
+            if not is_prefetcher_instance(prefetcher) and not callable(prefetcher):
                 raise InvalidPrefetch("Invalid prefetch definition %s. This prefetcher needs to be a class not an instance." % name)
+            connect_cache_invalidation(prefetcher)
 
     def get_queryset(self):
         qs = self.get_queryset_class()(
@@ -45,14 +683,204 @@ class PrefetchManager(PrefetchManagerMixin):
         super(PrefetchManager, self).__init__()
 
 
+class NamedValuesListIterable(query.ValuesListIterable):
+    """
+    Yields a named tuple for every row, like ``values_list(named=True)`` does since Django 2.0. Only used on older
+    versions, where it keeps the rows of the ``fields`` prefetchers a lazy queryset.
+    """
+
+    def __iter__(self):
+        row = collections.namedtuple('Row', self.queryset._fields)
+        for values in super(NamedValuesListIterable, self).__iter__():
+            yield row._make(values)
+
+
 class PrefetchIterable(query.ModelIterable):
+    def __init__(self, queryset, prefetch_chunk_size=None, **kwargs):
+        super(PrefetchIterable, self).__init__(queryset, **kwargs)
+        self.prefetch_chunk_size = prefetch_chunk_size
+
+    def iter_rows(self):
+        """
+        Iterates the objects of the queryset, without running the prefetchers.
+        """
+        return super(PrefetchIterable, self).__iter__()
+
     def __iter__(self):
-        data = list(super(PrefetchIterable, self).__iter__())
-        for name, (forwarders, prefetcher) in self.queryset._prefetch.items():
-            prefetcher.fetch(data, name, self.queryset.model, forwarders,
-                             getattr(self.queryset, '_db', None))
+        iterator = self.iter_rows()
+        if self.prefetch_chunk_size:
+            return self.iter_chunks(iterator)
+        with self.query_budget():
+            data = list(iterator)
+            self.prefetch(data)
         return iter(data)
 
+    def iter_chunks(self, iterator):
+        while True:
+            with self.query_budget():
+                chunk = list(itertools.islice(iterator, self.prefetch_chunk_size))
+                if chunk:
+                    self.prefetch(chunk)
+            if not chunk:
+                return
+            for obj in chunk:
+                yield obj
+
+    def prefetch(self, data, incremental=False):
+        """
+        Runs the prefetchers on ``data``. If ``incremental``, the objects that already got the data of a prefetcher
+        (from a previous incremental call) are skipped, and the others are marked as done.
+        """
+        if self.queryset._prefetch_identity_map:
+            share_related_instances(data)
+        if self.queryset._prefetch_lazy:
+            return self.prefetch_lazy(data)
+
+        datasets = collections.OrderedDict()
+        for name, (forwarders, prefetcher, nested) in self.queryset._prefetch.items():
+            if incremental:
+                marker = get_satisfied_marker(name, prefetcher, nested)
+                datasets[name] = [obj for obj in data if marker not in get_satisfied(obj, forwarders)]
+            else:
+                datasets[name] = data
+
+        sources = [
+            get_source_key(self.queryset.model, forwarders, prefetcher, nested)
+            for forwarders, prefetcher, nested in self.queryset._prefetch.values()
+        ]
+        sources = [source for source in sources if source is not None]
+        max_workers = self.queryset._prefetch_workers
+        if max_workers and workers_unusable():
+            max_workers = None
+        if ((max_workers or self.queryset._prefetch_union) and len(self.queryset._prefetch) > 1) or \
+                len(sources) != len(set(sources)):
+            self.prefetch_planned(datasets, max_workers)
+        else:
+            for name, (forwarders, prefetcher, nested) in self.queryset._prefetch.items():
+                if datasets[name]:
+                    prefetcher.fetch(datasets[name], name, self.queryset.model, forwarders,
+                                     getattr(self.queryset, '_db', None), nested)
+
+        if incremental:
+            for name, (forwarders, prefetcher, nested) in self.queryset._prefetch.items():
+                marker = get_satisfied_marker(name, prefetcher, nested)
+                for obj in datasets[name]:
+                    mark_satisfied(obj, forwarders, marker)
+
+    def get_query_budget(self):
+        limit = self.queryset._prefetch_query_budget
+        if limit is not None:
+            return QueryBudget(limit, "Evaluating a %s queryset" % self.queryset.model.__name__)
+
+    @contextmanager
+    def query_budget(self):
+        budget = self.get_query_budget()
+        if budget is None:
+            yield
+        else:
+            with budget:
+                yield
+
+    def prefetch_lazy(self, data):
+        model = self.queryset.model
+        db = getattr(self.queryset, '_db', None)
+        for name, (forwarders, prefetcher, nested) in self.queryset._prefetch.items():
+            if not prefetcher.attrs:
+                raise InvalidPrefetch("Invalid lazy prefetch call with %s on model %s. This prefetcher (%s) doesn't "
+                                      "have any attrs." % (name, model, prefetcher))
+            loader = LazyPrefetch(prefetcher, data, name, model, forwarders, db, nested)
+            for obj in data:
+                for field in forwarders:
+                    obj = getattr(obj, field, None)
+                if obj is None:
+                    continue
+                LazyPrefetchAttribute.install(obj.__class__, prefetcher.attrs)
+                pending = get_lazy_loaders(obj, create=True)
+                for attr in prefetcher.attrs:
+                    pending[attr] = loader
+
+    def plan(self, datasets):
+        """
+        Maps all the prefetchers and returns them in groups of ``PlannedPrefetch``. The prefetchers of a group share
+        a source, a single query is needed for every group.
+        """
+        model = self.queryset.model
+        groups = collections.OrderedDict()
+        for name, (forwarders, prefetcher, nested) in self.queryset._prefetch.items():
+            with logged_failure(name, model):
+                start = clock()
+                data_mapping = prefetcher.map_dataset(datasets[name], name, model, forwarders)
+                mapping_time = clock() - start
+            source = get_source_key(model, forwarders, prefetcher, nested)
+            group = (False, name) if source is None else (True,) + source
+            groups.setdefault(group, []).append(PlannedPrefetch(
+                name, forwarders, prefetcher, nested, data_mapping, len(datasets[name]), mapping_time
+            ))
+        return list(groups.values())
+
+    def prefetch_planned(self, datasets, max_workers):
+        """
+        Maps all the prefetchers first, then runs a single query for every group of prefetchers sharing a source
+        (concurrently if there are workers) and decorates in the order the prefetchers were given.
+        """
+        model = self.queryset.model
+        db = getattr(self.queryset, '_db', None)
+        # The cache is local to the thread (or asyncio task), get it before going in the workers.
+        cache = PrefetchCache.current()
+        budgets = QueryBudget.current()
+
+        groups = self.plan(datasets)
+        if max_workers and len(groups) > 1:
+            workers = min(max_workers, len(groups))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = start_query_workers(executor, workers, groups, model, db, cache, budgets)
+                for group, future in zip(groups, futures):
+                    decorate_group(group, future.result, model)
+        else:
+            combined = {}
+            if self.queryset._prefetch_union and cache is None:
+                for indexes, querysets in self.plan_union(groups, db):
+                    with logged_failure(groups[indexes[0]][0].name, model):
+                        results, secs = union_all(querysets)
+                    for index, related_data in zip(indexes, results):
+                        combined[index] = related_data, secs
+            for index, group in enumerate(groups):
+                leader = group[0]
+                if index in combined:
+                    query = functools.partial(operator.itemgetter(index), combined)
+                else:
+                    query = functools.partial(timed_query, leader.prefetcher, get_group_keys(group), leader.name, model,
+                                              db, leader.nested, cache)
+                decorate_group(group, query, model)
+
+    def plan_union(self, groups, db):
+        """
+        Finds the groups whose queries can be combined in a ``UNION ALL`` query (see
+        ``PrefetchQuerySet.prefetch_union``). Returns a list of ``(group indexes, querysets)``.
+        """
+        model = self.queryset.model
+        querysets = collections.OrderedDict()
+        for index, group in enumerate(groups):
+            leader = group[0]
+            prefetcher = leader.prefetcher
+            keys = get_group_keys(group)
+            batch_size = prefetcher.get_batch_size()
+            threshold = prefetcher.get_key_table_threshold()
+            if not keys or leader.nested or prefetcher.cache_alias or (batch_size and len(keys) > batch_size) or \
+                    (threshold and len(keys) > threshold):
+                continue
+            with logged_failure(leader.name, model):
+                queryset = prefetcher.get_related_data(keys, db)
+            ordering = get_union_ordering(queryset)
+            if ordering is not None and connections[queryset.db].features.supports_select_union:
+                querysets.setdefault((queryset.model, queryset.db, queryset._iterable_class, ordering), []).append(
+                    (index, queryset)
+                )
+        return [
+            ([index for index, _ in compatible], [queryset for _, queryset in compatible])
+            for compatible in querysets.values() if len(compatible) > 1
+        ]
+
 
 class InvalidPrefetch(Exception):
     pass
@@ -68,11 +896,105 @@ class PrefetchOption(object):
 P = PrefetchOption
 
 
+class PrefetchPlan(object):
+    """
+    What a prefetch name resolves to: the forward relations to follow (``forwarders``), the prefetch definition and
+    whatever is after it (``nested``). Plans are resolved once per model, prefetch definitions and name and then
+    reused for the whole process.
+    """
+    cache = {}
+
+    def __init__(self, key, forwarders, definition, nested):
+        self.key = key
+        self.forwarders = forwarders
+        self.definition = definition
+        self.nested = nested
+        self.prefetcher = None
+        self.validated = False
+
+    @classmethod
+    def resolve(cls, model, prefetch_definitions, name):
+        # The definitions are kept in the value so their id can't be reused while the plan is cached.
+        cache_key = model, id(prefetch_definitions), name
+        if cache_key not in cls.cache:
+            cls.cache[cache_key] = prefetch_definitions, cls.build(model, prefetch_definitions, name)
+        return cls.cache[cache_key][1]
+
+    @classmethod
+    def build(cls, model, prefetch_definitions, name):
+        parts = name.split('__')
+        forwarders = []
+        prefetcher = None
+        current_model = model
+
+        for position, what in enumerate(parts, 1):
+            if what in prefetch_definitions:
+                prefetcher = prefetch_definitions[what]
+                break
+            descriptor = getattr(current_model, what, None)
+            if isinstance(descriptor, ForwardManyToOneDescriptor):
+                field = descriptor.field
+                forwarders.append(field.name)
+                current_model = field.remote_field.model
+                manager = current_model.objects
+                if not isinstance(manager, PrefetchManagerMixin):
+                    raise InvalidPrefetch('Manager for %s is not a PrefetchManagerMixin instance.' % current_model)
+                prefetch_definitions = manager.prefetch_definitions
+            else:
+                raise InvalidPrefetch("Invalid part %s in prefetch call for %s on model %s. "
+                                      "The name is not a prefetcher nor a forward relation (fk)." % (
+                                          what, name, model))
+        if not prefetcher:
+            raise InvalidPrefetch("Invalid prefetch call with %s for on model %s. "
+                                  "The last part isn't a prefetch definition." % (name, model))
+
+        return cls('__'.join(parts[:position]), tuple(forwarders), prefetcher, '__'.join(parts[position:]))
+
+    def validate_nested(self, name, model, prefetcher, opt=None):
+        """
+        Resolves the nested prefetches on the model of the queryset ``filter`` (of ``prefetcher``) returns, so
+        invalid names are found even if there are no related objects. ``opt`` are the options for the nested
+        prefetchers.
+        """
+        if self.validated and prefetcher is self.prefetcher and opt is None:
+            return
+        check_nested(prefetcher, [self.nested])
+        related_data = prefetcher.filter([])
+        check_nested(prefetcher, [self.nested], related_data)
+        what = self.nested.split('__')[0]
+        definitions = related_data.prefetch_definitions or {}
+        if what not in definitions and not isinstance(getattr(related_data.model, what, None),
+                                                      ForwardManyToOneDescriptor):
+            raise InvalidPrefetch("Invalid part %s in prefetch call for %s on model %s. You cannot "
+                                  "have any more relations after the prefetcher." % (what, name, model))
+        plan = self.resolve(related_data.model, definitions, self.nested)
+        if plan.nested:
+            if opt and not is_prefetcher_instance(plan.definition):
+                plan.validate_nested(self.nested, related_data.model, plan.definition(*opt.args, **opt.kwargs))
+            else:
+                plan.validate_nested(self.nested, related_data.model, plan.get_prefetcher(), opt)
+        if prefetcher is self.prefetcher and opt is None:
+            self.validated = True
+
+    def get_prefetcher(self):
+        """
+        Returns the prefetcher to use when there are no options (instantiated only once for class definitions).
+        """
+        if self.prefetcher is None:
+            self.prefetcher = self.definition if is_prefetcher_instance(self.definition) else self.definition()
+        return self.prefetcher
+
+
 class PrefetchQuerySet(query.QuerySet):
     def __init__(self, model=None, query=None, using=None,
                  prefetch_definitions=None, **kwargs):
         super(PrefetchQuerySet, self).__init__(model, query, using, **kwargs)
         self._prefetch = {}
+        self._prefetch_workers = None
+        self._prefetch_lazy = False
+        self._prefetch_query_budget = None
+        self._prefetch_identity_map = False
+        self._prefetch_union = False
         self.prefetch_definitions = prefetch_definitions
         self._iterable_class = PrefetchIterable
 
@@ -80,16 +1002,115 @@ class PrefetchQuerySet(query.QuerySet):
         def _clone(self, **kwargs):
             return super(PrefetchQuerySet, self). \
                 _clone(_prefetch=self._prefetch,
+                       _prefetch_workers=self._prefetch_workers,
+                       _prefetch_lazy=self._prefetch_lazy,
+                       _prefetch_query_budget=self._prefetch_query_budget,
+                       _prefetch_identity_map=self._prefetch_identity_map,
+                       _prefetch_union=self._prefetch_union,
                        prefetch_definitions=self.prefetch_definitions, **kwargs)
     else:
         def _clone(self):
             c = super(PrefetchQuerySet, self)._clone()
             c._prefetch = self._prefetch
+            c._prefetch_workers = self._prefetch_workers
+            c._prefetch_lazy = self._prefetch_lazy
+            c._prefetch_query_budget = self._prefetch_query_budget
+            c._prefetch_identity_map = self._prefetch_identity_map
+            c._prefetch_union = self._prefetch_union
             c.prefetch_definitions = self.prefetch_definitions
             return c
 
+    def __aiter__(self):
+        """
+        Evaluates the queryset without blocking the event loop (``async for author in Author.objects.prefetch(...)``).
+        The queries of the prefetchers run concurrently in threads. Requires Python 3 and asgiref.
+        """
+        if not issubclass(self._iterable_class, PrefetchIterable) and django.VERSION >= (4, 1):
+            return super(PrefetchQuerySet, self).__aiter__()
+        from prefetch_async import aevaluate
+        return aevaluate(self)
+
+    def aiterator(self, chunk_size=None):
+        """
+        Asynchronous counterpart of ``iterator``, prefetchers run on every chunk of ``chunk_size`` objects.
+        """
+        if not issubclass(self._iterable_class, PrefetchIterable):
+            if django.VERSION >= (4, 1):
+                return super(PrefetchQuerySet, self).aiterator(chunk_size or 2000)
+            # Older versions don't have async iteration.
+            from prefetch_async import aiterate_rows
+            return aiterate_rows(iter(self.iterator(chunk_size or 2000)), chunk_size or 2000)
+        from prefetch_async import aiterate
+        return aiterate(self.iterator(chunk_size))
+
+    def prefetch_workers(self, max_workers):
+        """
+        Run the queries of the prefetchers concurrently, in a pool of at most ``max_workers`` threads (each thread
+        uses its own database connection). The related objects are still added in the same order as without
+        workers. Use ``None`` to go back to running the prefetchers one after another. Inside a transaction
+        (``atomic``, ``ATOMIC_REQUESTS``, ``TestCase``) the prefetchers run one after another anyway, as the other
+        connections wouldn't see the data of the transaction.
+        """
+        if max_workers is not None:
+            if ThreadPoolExecutor is None:
+                raise RuntimeError("Running prefetchers in parallel requires concurrent.futures "
+                                   "(install the futures backport on Python 2).")
+            if max_workers <= 0:
+                raise ValueError('max_workers must be strictly positive.')
+        obj = self._clone()
+        obj._prefetch_workers = max_workers
+        return obj
+
+    def prefetch_lazy(self, lazy=True):
+        """
+        Don't run the prefetchers when the queryset is evaluated. Instead, the first access to one of the ``attrs``
+        of a prefetcher, on any of the objects, runs that prefetcher for all the objects. Prefetchers that are not
+        used don't make any query. All the prefetchers need to have ``attrs``.
+        """
+        obj = self._clone()
+        obj._prefetch_lazy = lazy
+        return obj
+
+    def prefetch_identity_map(self, enabled=True):
+        """
+        Use a single instance for every related row loaded with ``select_related`` or through the forwarders (eg: the
+        author in ``Book.objects.prefetch('author__books')``), instead of one instance per object. Prefetchers then
+        decorate every related object only once. Beware that changing one of these objects changes it for all the
+        objects that refer to it. With ``iterator(chunk_size=...)`` the instances are shared within every chunk.
+        """
+        if enabled and django.VERSION < (2, 0):
+            raise RuntimeError("The identity map requires Django 2.0 or later.")
+        obj = self._clone()
+        obj._prefetch_identity_map = enabled
+        return obj
+
+    def prefetch_union(self, enabled=True):
+        """
+        Combine the queries of the prefetchers that load the same model (with the same columns and ordering) in a
+        single ``UNION ALL`` query, to save round trips to the database. Only plain querysets of model instances are
+        combined (no ``fields``, annotations, ``select_related``, slicing, nested prefetches or caching). Not used
+        with ``prefetch_workers`` or in a ``PrefetchCache``.
+        """
+        obj = self._clone()
+        obj._prefetch_union = enabled
+        return obj
+
+    def expect_queries(self, limit):
+        """
+        Fail with ``QueryBudgetExceeded`` if evaluating the queryset makes more than ``limit`` queries: the query of
+        the queryset plus all the queries of the prefetchers (batches, nested prefetches and worker threads
+        included). With ``iterator(chunk_size=...)`` every chunk has this budget. Lazy prefetchers (see
+        ``prefetch_lazy``) run later, outside of the budget. Use ``None`` to remove the budget.
+        """
+        if limit is not None and limit < 0:
+            raise ValueError('The query budget must be positive.')
+        obj = self._clone()
+        obj._prefetch_query_budget = limit
+        return obj
+
     def prefetch(self, *names):
         obj = self._clone()
+        obj._prefetch = dict(obj._prefetch)
 
         for opt in names:
             if isinstance(opt, PrefetchOption):
@@ -97,54 +1118,136 @@ class PrefetchQuerySet(query.QuerySet):
             else:
                 name = opt
                 opt = None
-            parts = name.split('__')
-            forwarders = []
-            prefetcher = None
-            model = self.model
-            prefetch_definitions = self.prefetch_definitions
-
-            for what in parts:
-                if not prefetcher:
-                    if what in prefetch_definitions:
-                        prefetcher = prefetch_definitions[what]
-                        continue
-                    descriptor = getattr(model, what, None)
-                    if isinstance(descriptor, ForwardManyToOneDescriptor):
-                        field = descriptor.field
-                        forwarders.append(field.name)
-                        model = field.remote_field.model
-                        manager = model.objects
-                        if not isinstance(manager, PrefetchManagerMixin):
-                            raise InvalidPrefetch('Manager for %s is not a PrefetchManagerMixin instance.' % model)
-                        prefetch_definitions = manager.prefetch_definitions
-                    else:
-                        raise InvalidPrefetch("Invalid part %s in prefetch call for %s on model %s. "
-                                              "The name is not a prefetcher nor a forward relation (fk)." % (
-                                                  what, name, self.model))
-                else:
-                    raise InvalidPrefetch("Invalid part %s in prefetch call for %s on model %s. "
-                                          "You cannot have any more relations after the prefetcher." % (
-                                              what, name, self.model))
-            if not prefetcher:
-                raise InvalidPrefetch("Invalid prefetch call with %s for on model %s. "
-                                      "The last part isn't a prefetch definition." % (name, self.model))
+            plan = PrefetchPlan.resolve(self.model, self.prefetch_definitions, name)
+
+            existing = obj._prefetch.get(plan.key)
+            nested = existing[2] if existing else ()
+            nested_opt = None
+            if plan.nested:
+                # Whatever is after the prefetcher gets prefetched on the related objects. The options are for the
+                # first prefetcher that takes them (a class), instances pass them on to the nested prefetchers.
+                if opt and is_prefetcher_instance(plan.definition):
+                    nested_opt, opt = opt, None
+                nested += (PrefetchOption(plan.nested, *nested_opt.args, **nested_opt.kwargs) if nested_opt
+                           else plan.nested,)
+
             if opt:
-                if prefetcher.__class__ is Prefetcher:
+                if is_prefetcher_instance(plan.definition):
                     raise InvalidPrefetch("Invalid prefetch call with %s for on model %s. "
                                           "This prefetcher (%s) needs to be a subclass of Prefetcher." % (
-                                              name, self.model, prefetcher))
+                                              name, self.model, plan.definition))
 
-                obj._prefetch[name] = forwarders, prefetcher(*opt.args, **opt.kwargs)
+                prefetcher = plan.definition(*opt.args, **opt.kwargs)
+                prefetcher.prefetch_option = describe_option(opt)
+                connect_cache_invalidation(prefetcher)
+            elif existing and plan.nested:
+                prefetcher = existing[1]
             else:
-                obj._prefetch[name] = forwarders, prefetcher if prefetcher.__class__ is Prefetcher else prefetcher()
+                prefetcher = plan.get_prefetcher()
+            if plan.nested:
+                plan.validate_nested(name, self.model, prefetcher, nested_opt)
+            obj._prefetch[plan.key] = existing[0] if existing else plan.forwarders, prefetcher, nested
 
-        for forwarders, prefetcher in obj._prefetch.values():
+        for forwarders, prefetcher, nested in obj._prefetch.values():
             if forwarders:
                 obj = obj.select_related('__'.join(forwarders))
         return obj
 
-    def iterator(self):
-        return self._iterable_class(self)
+    def iterator(self, chunk_size=None):
+        if chunk_size is None:
+            return self._iterable_class(self)
+        if chunk_size <= 0:
+            raise ValueError('Chunk size must be strictly positive.')
+
+        kwargs = {
+            'chunked_fetch': not connections[self.db].settings_dict.get('DISABLE_SERVER_SIDE_CURSORS'),
+        }
+        if django.VERSION >= (2, 0):
+            kwargs['chunk_size'] = chunk_size
+        if issubclass(self._iterable_class, PrefetchIterable):
+            kwargs['prefetch_chunk_size'] = chunk_size
+        return self._iterable_class(self, **kwargs)
+
+
+class PrefetchCache(object):
+    """
+    Cache for the related data of the prefetchers, for the scope of a ``with`` block (eg: a request). Inside the
+    block prefetchers only query the keys they haven't seen yet, the related objects of the other keys are reused.
+    Eg::
+
+        with PrefetchCache():
+            authors = list(Author.objects.prefetch('books'))
+            # only queries the books of the authors that weren't in the first list
+            featured = list(Author.objects.filter(featured=True).prefetch('books'))
+
+    Note that the related objects are shared, don't change them in the decorators. Prefetchers with options (``P``)
+    are distinct instances in every prefetch call, so they don't reuse cached data. The cache is cleared when the
+    block ends. In async code the cache is only used by the current task.
+    """
+    local = Local()
+
+    def __init__(self):
+        self.data = {}
+
+    @classmethod
+    def current(cls):
+        stack = getattr(cls.local, 'stack', ())
+        return stack[-1] if stack else None
+
+    def __enter__(self):
+        self.local.stack = getattr(self.local, 'stack', ()) + (self,)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.local.stack = tuple(i for i in self.local.stack if i is not self)
+        self.data.clear()
+
+    def get_related_data(self, prefetcher, keys, db, nested):
+        entries = self.data.setdefault((prefetcher, db, nested), {})
+        missing = [key for key in keys if key not in entries]
+        if missing:
+            relation_mapping = prefetcher.get_relation_mapping(prefetcher.fetch_related_data(missing, db, nested))
+            for key in missing:
+                entries[key] = relation_mapping.get(key, [])
+        return RelatedData(prefetcher, keys, entries)
+
+
+def prefetch_objects(instances, *names, **kwargs):
+    """
+    Runs the prefetches (names or ``P`` options, like for ``PrefetchQuerySet.prefetch``) on already loaded instances
+    of a model that has a ``PrefetchManagerMixin`` manager, without querying them again. Eg::
+
+        authors = cache.get('authors')
+        prefetch_objects(authors, 'books', P('latest_n_books', count=5))
+
+    Use ``select_related`` when loading the instances if you prefetch through foreign keys (``'author__books'``),
+    otherwise every instance will make a query to get the related object.
+
+    With ``incremental=True`` the instances that already got the data of a prefetch (in a previous incremental
+    call) are skipped, eg: when a new page is added to a list that was already prefetched::
+
+        prefetch_objects(authors, 'books', incremental=True)
+        authors.extend(next_page)
+        prefetch_objects(authors, 'books', incremental=True)  # only queries the books of next_page
+
+    ``P`` options make a new prefetcher in every call so they are never skipped.
+    """
+    incremental = kwargs.pop('incremental', False)
+    if kwargs:
+        raise TypeError("Unexpected arguments: %s" % ', '.join(kwargs))
+    instances = list(instances)
+    if not instances:
+        return
+    model = instances[0].__class__
+    manager = model.objects
+    if not isinstance(manager, PrefetchManagerMixin):
+        raise InvalidPrefetch('Manager for %s is not a PrefetchManagerMixin instance.' % model)
+
+    queryset = manager.get_queryset().prefetch(*names)
+    db = instances[0]._state.db
+    if db is not None:
+        queryset = queryset.using(db)
+    PrefetchIterable(queryset).prefetch(instances, incremental)
 
 
 class Prefetcher(object):
@@ -192,6 +1295,15 @@ class Prefetcher(object):
         A function that takes the related object as argument and returns a list
         of keys that maps that related object to the objects in the queryset.
 
+    * key_attr and related_key_attr:
+
+        Optional.
+
+        Attribute names to use instead of ``mapper`` (the key of your objects) and ``reverse_mapper`` (the single
+        key of a related object). Reading an attribute is a lot cheaper than calling a function for every object,
+        eg: ``related_key_attr='author_id'``. For more control, override ``mapper_many`` and
+        ``reverse_mapper_many``, they get all the objects at once.
+
     * mapper(object):
 
         Optional (defaults to ``lambda obj: obj.pk``).
@@ -203,20 +1315,96 @@ class Prefetcher(object):
         A function that will save the related data on each of your objects in
         your queryset. Takes the object and a list of related objects as
         arguments. Note that you should not override existing attributes on the
-        model instance here.
+        model instance here. It's called once for every object, without the
+        list for the objects that have no related objects (so give it a
+        default).
+
+    * batch_size:
+
+        Optional (defaults to the ``PREFETCH_BATCH_SIZE`` setting, or no batching if that isn't set).
+
+        The maximum number of keys passed to a single ``filter`` call. If there are more keys, ``filter`` is
+        called once for every batch and the results are merged.
+
+    * key_table_threshold:
+
+        Optional (defaults to the ``PREFETCH_KEY_TABLE_THRESHOLD`` setting, or never if that isn't set).
+
+        If there are more keys than this, ``filter`` doesn't get a list of keys but a subquery (that can be used in
+        ``__in`` lookups) and the keys are sent in a single array parameter (PostgreSQL) or loaded in a temporary
+        table (SQLite and MySQL). The number of queries and their SQL then stay the same no matter how many keys
+        there are. Takes precedence over ``batch_size``. Only for integer and string keys, and ``filter`` must
+        only use the keys in ``__in`` lookups.
+
+    * source:
+
+        Optional.
+
+        A name for the query made by ``filter``. Prefetchers of a model that have the same source must have
+        equivalent ``filter`` functions: when several of them are used on the same queryset the query is run only
+        once (with all their keys) and the related objects are passed to each of their ``reverse_mapper`` and
+        ``decorator``.
+
+    * fields:
+
+        Optional.
+
+        A list of field names (like for ``QuerySet.values_list``). If given, only these columns are fetched and
+        ``reverse_mapper`` and ``decorator`` get named tuples instead of model instances. This is a lot cheaper if
+        you don't need the instances. You can also just return a ``values()`` or ``values_list()`` queryset from
+        ``filter``.
+
+    * cache_alias, cache_prefix, cache_timeout and cache_models:
+
+        Optional.
+
+        Keeps the related data of every key in the ``cache_alias`` Django cache, under keys starting with
+        ``cache_prefix`` (required if there's a ``cache_alias``), for ``cache_timeout`` seconds (defaults to the
+        timeout of the cache). Only the keys missing from the cache are queried. Saving or deleting any of the
+        ``cache_models`` (models or ``"app_label.ModelName"``, include the ``through`` models of many-to-many
+        relations) invalidates all the cached data of the prefetcher. Meant for related data that rarely changes.
+        Nested prefetches are never cached.
+
+    * attrs:
+
+        Optional.
+
+        The names of the attributes the decorator sets. Only needed to use the prefetcher lazily (see
+        ``PrefetchQuerySet.prefetch_lazy``).
 
     """
     collect = False
-
-    def __init__(self, filter=None, reverse_mapper=None, decorator=None, mapper=None, collect=None):
+    batch_size = None
+    source = None
+    fields = None
+    cache_alias = None
+    cache_prefix = None
+    cache_timeout = DEFAULT_TIMEOUT
+    cache_models = ()
+    attrs = ()
+    key_attr = None
+    related_key_attr = None
+    key_table_threshold = None
+
+    def __init__(self, filter=None, reverse_mapper=None, decorator=None, mapper=None, collect=None,
+                 batch_size=None, source=None, fields=None, cache_alias=None, cache_prefix=None,
+                 cache_timeout=DEFAULT_TIMEOUT, cache_models=None, attrs=None, key_attr=None, related_key_attr=None,
+                 key_table_threshold=None):
         if filter:
             self.filter = filter
         elif not hasattr(self, 'filter'):
             raise RuntimeError("You must define a filter function")
 
+        if key_attr is not None:
+            self.key_attr = key_attr
+
+        if related_key_attr is not None:
+            self.related_key_attr = related_key_attr
+
         if reverse_mapper:
             self.reverse_mapper = reverse_mapper
-        elif not hasattr(self, 'reverse_mapper'):
+        elif not hasattr(self, 'reverse_mapper') and self.related_key_attr is None and \
+                type(self).reverse_mapper_many == Prefetcher.reverse_mapper_many:
             raise RuntimeError("You must define a reverse_mapper function")
 
         if decorator:
@@ -230,60 +1418,360 @@ class Prefetcher(object):
         if collect is not None:
             self.collect = collect
 
+        if batch_size is not None:
+            self.batch_size = batch_size
+
+        if key_table_threshold is not None:
+            self.key_table_threshold = key_table_threshold
+
+        if source is not None:
+            self.source = source
+
+        if fields is not None:
+            self.fields = tuple(fields)
+
+        if cache_alias is not None:
+            self.cache_alias = cache_alias
+
+        if cache_prefix is not None:
+            self.cache_prefix = cache_prefix
+
+        if cache_timeout is not DEFAULT_TIMEOUT:
+            self.cache_timeout = cache_timeout
+
+        if cache_models is not None:
+            self.cache_models = cache_models
+
+        if attrs is not None:
+            self.attrs = tuple(attrs)
+
     @staticmethod
     def mapper(obj):
         return obj.pk
 
-    def fetch(self, dataset, name, model, forwarders, db):
+    def get_key_table_threshold(self):
+        if self.key_table_threshold is not None:
+            return self.key_table_threshold
+        return getattr(settings, 'PREFETCH_KEY_TABLE_THRESHOLD', None)
+
+    def mapper_many(self, objs):
+        """
+        Returns the keys of ``objs``, in the same order.
+        """
+        if self.key_attr is not None:
+            return list(map(operator.attrgetter(self.key_attr), objs))
+        return [self.mapper(obj) for obj in objs]
+
+    def reverse_mapper_many(self, related_data):
+        """
+        Returns ``(key, related object)`` pairs for all the keys of all the related objects.
+        """
+        if self.related_key_attr is not None:
+            if not isinstance(related_data, (list, tuple)):
+                related_data = list(related_data)
+            return zip(map(operator.attrgetter(self.related_key_attr), related_data), related_data)
+        return ((key, obj) for obj in related_data for key in self.reverse_mapper(obj))
+
+    def get_batch_size(self):
+        if self.batch_size is not None:
+            return self.batch_size
+        return getattr(settings, 'PREFETCH_BATCH_SIZE', None)
+
+    def get_related_data(self, ids, db, nested=()):
+        related_data = self.filter(ids)
+        if db is not None:
+            related_data = related_data.using(db)
+        if nested:
+            check_nested(self, nested, related_data)
+            related_data = related_data.prefetch(*nested)
+        if self.fields:
+            if django.VERSION >= (2, 0):
+                related_data = related_data.values_list(*self.fields, named=True)
+            else:
+                related_data = related_data.values_list(*self.fields)
+                related_data._iterable_class = NamedValuesListIterable
+        return related_data
+
+    def fetch_related_data(self, keys, db, nested=()):
+        if self.cache_alias and not nested:
+            return self.fetch_cached_related_data(keys, db)
+        return self.fetch_batches(keys, db, nested)
+
+    def fetch_cached_related_data(self, keys, db):
+        cache = caches[self.cache_alias]
+        prefix = 'prefetch:%s:%s:%s' % (self.cache_prefix, get_cache_version(cache, self.cache_prefix), db or '')
+        cache_keys = dict(('%s:%s' % (prefix, key), key) for key in keys)
+        entries = dict((cache_keys[cache_key], value) for cache_key, value in cache.get_many(list(cache_keys)).items())
+        missing = [key for key in keys if key not in entries]
+        if missing:
+            relation_mapping = self.get_relation_mapping(self.fetch_batches(missing, db))
+            fetched = dict((key, relation_mapping.get(key, [])) for key in missing)
+            cache.set_many(dict(('%s:%s' % (prefix, key), value) for key, value in fetched.items()), self.cache_timeout)
+            entries.update(fetched)
+        return RelatedData(self, keys, entries)
+
+    def fetch_batches(self, keys, db, nested=()):
+        threshold = self.get_key_table_threshold()
+        if threshold and len(keys) > threshold:
+            key_table = KeyTable(keys)
+            related_data = self.get_related_data(key_table, db, nested)
+            connection = connections[getattr(related_data, 'db', None) or db or DEFAULT_DB_ALIAS]
+            if connection.vendor in KeyTable.vendors:
+                with key_table.loaded(connection):
+                    return list(related_data)
+
+        batch_size = self.get_batch_size()
+        if not batch_size or len(keys) <= batch_size:
+            return self.get_related_data(keys, db, nested)
+
+        keys = list(keys)
+        related_data = []
+        for start in range(0, len(keys), batch_size):
+            related_data.extend(self.get_related_data(keys[start:start + batch_size], db, nested))
+        return related_data
+
+    def map_dataset(self, dataset, name, model, forwarders):
         collect = self.collect or forwarders
-
-        try:
-            data_mapping = collections.defaultdict(list)
-            t1 = time.time()
+        if forwarders:
+            # Forwarded objects can be shared by several objects (see ``prefetch_identity_map``), decorate them once.
+            objs = []
+            seen = set()
             for obj in dataset:
                 for field in forwarders:
                     obj = getattr(obj, field, None)
-
-                if not obj:
-                    continue
-
-                if collect:
-                    data_mapping[self.mapper(obj)].append(obj)
+                if obj and id(obj) not in seen:
+                    seen.add(id(obj))
+                    objs.append(obj)
+        else:
+            objs = [obj for obj in dataset if obj]
+
+        data_mapping = collections.defaultdict(list)
+        for key, obj in zip(self.mapper_many(objs), objs):
+            if collect:
+                data_mapping[key].append(obj)
+            else:
+                replaced = data_mapping.get(key)
+                if replaced is not None and replaced is not obj:
+                    # Only the last object with this key gets the related objects (use collect to avoid this).
+                    self.decorator(replaced)
+                data_mapping[key] = obj
+        return data_mapping
+
+    def query(self, keys, name, model, db, nested=(), cache=None):
+        if cache is None:
+            return list(self.fetch_related_data(keys, db, nested))
+        return cache.get_related_data(self, keys, db, nested)
+
+    def get_relation_mapping(self, related_data):
+        if isinstance(related_data, RelatedData) and related_data.prefetcher is self:
+            return related_data.relation_mapping
+        relation_mapping = collections.defaultdict(list)
+        for id_, obj in self.reverse_mapper_many(related_data):
+            if id_:
+                relation_mapping[id_].append(obj)
+        return relation_mapping
+
+    def decorate(self, data_mapping, related_data, name, model, forwarders):
+        # Every object is decorated once, with its related objects or with the defaults of the decorator.
+        collect = self.collect or forwarders
+        relation_mapping = self.get_relation_mapping(related_data)
+        decorator = self.decorator
+        for id_, items in data_mapping.items():
+            related_items = relation_mapping.get(id_)
+            for item in items if collect else (items,):
+                if related_items is None:
+                    decorator(item)
                 else:
-                    data_mapping[self.mapper(obj)] = obj
-
-                self.decorator(obj)
-
-            t2 = time.time()
-            logger.debug("Creating data_mapping for %s query took %.3f secs for the %s prefetcher.",
-                         model.__name__, t2-t1, name)
-            t1 = time.time()
-            related_data = self.filter(data_mapping.keys())
-            if db is not None:
-                related_data = related_data.using(db)
-            related_data_len = len(related_data)
-            t2 = time.time()
-            logger.debug("Filtering for %s related objects for %s query took %.3f secs for the %s prefetcher.",
-                         related_data_len, model.__name__, t2-t1, name)
-            relation_mapping = collections.defaultdict(list)
-
-            t1 = time.time()
-            for obj in related_data:
-                for id_ in self.reverse_mapper(obj):
-                    if id_:
-                        relation_mapping[id_].append(obj)
-            for id_, related_items in relation_mapping.items():
-                if id_ in data_mapping:
-                    if collect:
-                        for item in data_mapping[id_]:
-                            self.decorator(item, related_items)
-                    else:
-                        self.decorator(data_mapping[id_], related_items)
-
-            t2 = time.time()
-            logger.debug("Adding the related objects on the %s query took %.3f secs for the %s prefetcher.",
-                         model.__name__, t2-t1, name)
+                    decorator(item, related_items)
+
+    def fetch(self, dataset, name, model, forwarders, db, nested=()):
+        with logged_failure(name, model):
+            t1 = clock()
+            data_mapping = self.map_dataset(dataset, name, model, forwarders)
+            t2 = clock()
+            related_data = self.query(data_mapping.keys(), name, model, db, nested, PrefetchCache.current())
+            t3 = clock()
+            self.decorate(data_mapping, related_data, name, model, forwarders)
+            t4 = clock()
+            send_prefetched(self, name, model, len(dataset), data_mapping, related_data, t2 - t1, t3 - t2, t4 - t3)
             return dataset
-        except Exception:
-            logger.exception("Prefetch failed for %s prefetch on the %s model:", name, model.__name__)
-            raise
+
+    def afetch(self, dataset, name, model, forwarders, db, nested=()):
+        """
+        Coroutine version of ``fetch``: the query runs in a thread, without blocking the event loop.
+        """
+        from prefetch_async import afetch
+        return afetch(self, dataset, name, model, forwarders, db, nested)
+
+
+class ForeignKeyPrefetcher(Prefetcher):
+    """
+    Base class for prefetchers of a model that has a foreign key to the objects in your queryset. Subclasses need
+    to set:
+
+    * model: the related model (or its ``"app_label.ModelName"``).
+    * key: the name of the foreign key on the related model that points to the objects in your queryset.
+    """
+    model = None
+    key = None
+
+    def __init__(self, **kwargs):
+        if self.model is None or self.key is None:
+            raise RuntimeError("You must define the model and key attributes")
+        super(ForeignKeyPrefetcher, self).__init__(**kwargs)
+
+    def get_model(self):
+        if isinstance(self.model, type):
+            return self.model
+        return apps.get_model(self.model)
+
+    def get_queryset(self):
+        return self.get_model()._default_manager.all()
+
+    def filter(self, ids):
+        return self.get_queryset().filter(**{'%s__in' % self.key: ids})
+
+    def reverse_mapper(self, obj):
+        return [getattr(obj, self.get_model()._meta.get_field(self.key).attname)]
+
+
+class ReverseFK(ForeignKeyPrefetcher):
+    """
+    Declarative prefetcher for the objects of ``model`` that have a ``key`` foreign key to the objects in your
+    queryset. The related objects are saved as a list in the ``to_attr`` attribute (an empty tuple if there are
+    none). Eg::
+
+        ReverseFK(Book, 'author', to_attr='books')
+
+    Does the same thing as::
+
+        Prefetcher(
+            filter=lambda ids: Book.objects.filter(author__in=ids),
+            reverse_mapper=lambda book: [book.author_id],
+            decorator=lambda author, books=(): setattr(author, 'books', books)
+        )
+
+    but faster, as the key column is read directly instead of calling ``reverse_mapper`` for every related object.
+    Unlike other ``Prefetcher`` subclasses, use instances in the prefetch definitions.
+    """
+
+    def __init__(self, model, key, to_attr, **kwargs):
+        self.model = model
+        self.key = key
+        self.to_attr = to_attr
+        kwargs.setdefault('attrs', [to_attr])
+        super(ReverseFK, self).__init__(**kwargs)
+
+    explicit_related_key_attr = None
+
+    @property
+    def related_key_attr(self):
+        if self.explicit_related_key_attr is not None:
+            return self.explicit_related_key_attr
+        return self.get_model()._meta.get_field(self.key).attname
+
+    @related_key_attr.setter
+    def related_key_attr(self, value):
+        self.explicit_related_key_attr = value
+
+    def decorator(self, obj, related_objects=()):
+        setattr(obj, self.to_attr, related_objects)
+
+
+class TopNPrefetcher(ForeignKeyPrefetcher):
+    """
+    Prefetcher that only fetches the first ``count`` related objects of each key, the limit is applied in the
+    database (with ``ROW_NUMBER() OVER (PARTITION BY ...)``) so the other rows are never transferred. Subclass it
+    and set ``model`` and ``key`` (see ``ForeignKeyPrefetcher``) and:
+
+    * order_by: the ordering (a list of field names, like for ``QuerySet.order_by``) used to pick the first
+      objects. The decorator receives the related objects in this order.
+    * count: optional (defaults to ``1``), can be given as an option too, eg: ``P('latest_n_books', count=5)``.
+
+    You only need to define the decorator. Eg::
+
+        class LatestNBooks(TopNPrefetcher):
+            model = Book
+            key = 'author'
+            order_by = ['-created']
+
+            @staticmethod
+            def decorator(author, books=()):
+                setattr(author, 'latest_books', books)
+
+    Older Django versions (before 4.2) can't filter on window functions, a correlated subquery with a ``LIMIT``
+    is used instead. MySQL doesn't support ``LIMIT`` in that subquery, use Django 4.2 or later there.
+    """
+    order_by = ()
+    count = 1
+
+    def __init__(self, count=None, **kwargs):
+        if not self.order_by:
+            raise RuntimeError("You must define the order_by attribute")
+        if count is not None:
+            self.count = count
+        super(TopNPrefetcher, self).__init__(**kwargs)
+
+    def get_ordering(self):
+        return [F(field[1:]).desc() if field.startswith('-') else F(field).asc() for field in self.order_by]
+
+    def filter(self, ids):
+        queryset = super(TopNPrefetcher, self).filter(ids)
+        if django.VERSION >= (4, 2):
+            queryset = queryset.annotate(
+                prefetch_row_number=Window(RowNumber(), partition_by=[F(self.key)], order_by=self.get_ordering())
+            ).filter(prefetch_row_number__lte=self.count)
+        else:
+            queryset = queryset.filter(pk__in=Subquery(
+                self.get_queryset().filter(**{self.key: OuterRef(self.key)}).order_by(*self.order_by).values('pk')[:self.count]
+            ))
+        # The column, ordering by the foreign key itself would join the related table for its Meta.ordering.
+        return queryset.order_by(self.get_model()._meta.get_field(self.key).attname, *self.order_by)
+
+
+class AggregatePrefetcher(ForeignKeyPrefetcher):
+    """
+    Prefetcher for aggregates of the related objects (counts, sums, latest dates etc). A single ``GROUP BY`` query
+    is made and no related objects are loaded. Subclass it and set ``model`` and ``key`` (see
+    ``ForeignKeyPrefetcher``) and:
+
+    * aggregates: a dict of attribute names and aggregate expressions. Every object in your queryset gets these
+      attributes.
+    * defaults: optional, a dict with the values for objects that don't have any related objects. Aggregates missing
+      from it default to ``None``.
+
+    Eg::
+
+        class BookStats(AggregatePrefetcher):
+            model = Book
+            key = 'author'
+            aggregates = {'book_count': Count('pk'), 'last_published': Max('created')}
+            defaults = {'book_count': 0}
+    """
+    aggregates = {}
+    defaults = {}
+
+    def __init__(self, **kwargs):
+        if not self.aggregates:
+            raise RuntimeError("You must define the aggregates attribute")
+        super(AggregatePrefetcher, self).__init__(**kwargs)
+
+    @property
+    def attrs(self):
+        return tuple(self.aggregates)
+
+    def filter(self, ids):
+        return super(AggregatePrefetcher, self).filter(ids).values(self.key).annotate(**self.aggregates).order_by()
+
+    def reverse_mapper(self, row):
+        return [row[self.key]]
+
+    def reverse_mapper_many(self, rows):
+        if not isinstance(rows, (list, tuple)):
+            rows = list(rows)
+        return zip(map(operator.itemgetter(self.key), rows), rows)
+
+    def decorator(self, obj, rows=()):
+        row = rows[0] if rows else self.defaults
+        for name in self.aggregates:
+            setattr(obj, name, row.get(name))
@@ -0,0 +1,136 @@
+"""
+Asyncio support for ``prefetch``. It needs Python 3 and asgiref (Django 3.0 or later), that's why it's not in the
+``prefetch`` module. Use it through ``PrefetchQuerySet.__aiter__``, ``PrefetchQuerySet.aiterator`` and
+``Prefetcher.afetch``.
+
+The queries run in threads (each with its own database connection, like with ``prefetch_workers``) so they don't
+block the event loop, and the queries of the prefetchers run concurrently. The related objects are still added in
+the order the prefetchers were given, in the event loop. Query budgets and ``PrefetchCache`` blocks only apply to
+the task they're used in. The attributes of lazy prefetches can't be loaded from async code (Django raises
+``SynchronousOnlyOperation``), use ``sync_to_async`` for that.
+"""
+import asyncio
+import collections
+import functools
+import itertools
+
+from asgiref.sync import sync_to_async
+
+from prefetch import PrefetchCache
+from prefetch import PrefetchIterable
+from prefetch import QueryBudget
+from prefetch import clock
+from prefetch import decorate_group
+from prefetch import get_group_keys
+from prefetch import logged_failure
+from prefetch import query_in_thread
+from prefetch import send_prefetched
+from prefetch import share_related_instances
+
+
+def fetch_rows(rows, count, budgets):
+    with QueryBudget.counting(budgets):
+        return list(itertools.islice(rows, count))
+
+
+def get_result(result):
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+
+async def afetch(prefetcher, dataset, name, model, forwarders, db, nested=()):
+    with logged_failure(name, model):
+        t1 = clock()
+        data_mapping = prefetcher.map_dataset(dataset, name, model, forwarders)
+        t2 = clock()
+        related_data, _ = await sync_to_async(query_in_thread, thread_sensitive=False)(
+            prefetcher, list(data_mapping), name, model, db, nested, PrefetchCache.current(), QueryBudget.current()
+        )
+        t3 = clock()
+        prefetcher.decorate(data_mapping, related_data, name, model, forwarders)
+        t4 = clock()
+        send_prefetched(prefetcher, name, model, len(dataset), data_mapping, related_data, t2 - t1, t3 - t2, t4 - t3)
+        return dataset
+
+
+async def aprefetch(iterable, data, budgets=None):
+    """
+    Coroutine version of ``PrefetchIterable.prefetch``. The queries count for the ``budgets`` (defaults to the ones
+    of the current task).
+    """
+    queryset = iterable.queryset
+    if queryset._prefetch_identity_map:
+        share_related_instances(data)
+    if queryset._prefetch_lazy:
+        return iterable.prefetch_lazy(data)
+
+    model = queryset.model
+    db = getattr(queryset, '_db', None)
+    cache = PrefetchCache.current()
+    if budgets is None:
+        budgets = QueryBudget.current()
+    groups = iterable.plan(collections.OrderedDict((name, data) for name in queryset._prefetch))
+    limit = asyncio.Semaphore(queryset._prefetch_workers or len(groups) or 1)
+    query = sync_to_async(query_in_thread, thread_sensitive=False)
+
+    async def run(group):
+        leader = group[0]
+        async with limit:
+            return await query(leader.prefetcher, list(get_group_keys(group)), leader.name, model, db, leader.nested,
+                               cache, budgets)
+
+    # Failures are raised in order, when decorating, same as without asyncio.
+    results = await asyncio.gather(*[run(group) for group in groups], return_exceptions=True)
+    for group, result in zip(groups, results):
+        decorate_group(group, functools.partial(get_result, result), model)
+
+
+async def aiterate(iterable):
+    """
+    Coroutine version of ``PrefetchIterable.__iter__``.
+    """
+    rows = iterable.iter_rows()
+    chunk_size = iterable.prefetch_chunk_size
+    while True:
+        # The budget isn't entered in the event loop, it's given to the queries explicitly and checked after them.
+        budget = iterable.get_query_budget()
+        budgets = QueryBudget.current() + ((budget,) if budget else ())
+        chunk = await sync_to_async(fetch_rows)(rows, chunk_size, budgets)
+        if chunk:
+            await aprefetch(iterable, chunk, budgets)
+        if budget is not None:
+            budget.check()
+        for obj in chunk:
+            yield obj
+        if not chunk or not chunk_size:
+            return
+
+
+async def aiterate_rows(rows, chunk_size):
+    """
+    Iterates ``rows`` (of a queryset without prefetches) fetching ``chunk_size`` rows at a time in a thread, for
+    Django versions older than 4.1 that don't have ``QuerySet.aiterator``.
+    """
+    while True:
+        chunk = await sync_to_async(fetch_rows)(rows, chunk_size, ())
+        if not chunk:
+            return
+        for obj in chunk:
+            yield obj
+
+
+async def aevaluate(queryset):
+    """
+    Coroutine version of ``QuerySet.__iter__``: the objects are kept in the result cache of the queryset.
+    """
+    if queryset._result_cache is None:
+        if issubclass(queryset._iterable_class, PrefetchIterable):
+            queryset._result_cache = [obj async for obj in aiterate(queryset._iterable_class(queryset))]
+        else:
+            # Django < 4.1 doesn't have QuerySet.__aiter__.
+            await sync_to_async(queryset._fetch_all)()
+    if queryset._prefetch_related_lookups and not queryset._prefetch_done:
+        await sync_to_async(queryset._prefetch_related_objects)()
+    for obj in queryset._result_cache:
+        yield obj
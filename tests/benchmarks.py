@@ -0,0 +1,167 @@
+"""
+Benchmarks for the prefetch pipeline, using the ``test_app`` models on a seeded SQLite database.
+
+Run them with::
+
+    tox -e benchmark -- --authors 1000
+
+Or directly::
+
+    PYTHONPATH=src:tests DJANGO_SETTINGS_MODULE=test_project.settings python tests/benchmarks.py --authors 1000
+
+Every benchmark is reported with the best time of the repeats, the parent rows per second, the number of queries and
+the peak memory (traced with ``tracemalloc``). Where Django's ``prefetch_related`` can do the same thing it is
+benchmarked too, on the same data.
+"""
+from __future__ import print_function
+
+import argparse
+import random
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+import django
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from prefetch import P
+
+try:
+    clock = time.perf_counter
+except AttributeError:  # Python 2
+    clock = time.time
+
+
+def seed(authors=100, books_per_author=10, tags=50, tags_per_book=3, notes_per_book=1, random_seed=0):
+    from test_app.models import Author
+    from test_app.models import Book
+    from test_app.models import BookNote
+    from test_app.models import Publisher
+    from test_app.models import Tag
+
+    rng = random.Random(random_seed)
+    # Query them back, bulk_create only sets the primary keys on some databases (and SQLite since Django 4.0).
+    Publisher.objects.bulk_create([Publisher(name="Publisher %s" % i) for i in range(10)])
+    publishers = list(Publisher.objects.all())
+    Tag.objects.bulk_create([Tag(name="Tag %s" % i) for i in range(tags)])
+    tag_objects = list(Tag.objects.all())
+    Author.objects.bulk_create([Author(name="Author %s" % i) for i in range(authors)])
+    Book.objects.bulk_create([
+        Book(name="Book %s/%s" % (author.pk, i), author=author, publisher=rng.choice(publishers))
+        for author in Author.objects.all()
+        for i in range(books_per_author)
+    ])
+    books = list(Book.objects.all())
+    Book.tags.through.objects.bulk_create([
+        Book.tags.through(book=book, tag=tag)
+        for book in books
+        for tag in rng.sample(tag_objects, min(tags_per_book, len(tag_objects)))
+    ])
+    BookNote.objects.bulk_create([
+        BookNote(book=book, notes="Note %s" % i)
+        for book in books
+        for i in range(notes_per_book)
+    ])
+
+
+def get_benchmarks():
+    """
+    Returns a list of ``(name, implementation, queryset factory)``.
+    """
+    from test_app.models import Author
+    from test_app.models import Book
+    from test_app.models import BookNote
+
+    benchmarks = [
+        ('authors', 'plain', lambda: Author.objects.all()),
+        ('books', 'prefetch', lambda: Author.objects.prefetch('books')),
+        ('books', 'prefetch_related', lambda: Author.objects.prefetch_related('book_set')),
+        ('books-declarative', 'prefetch', lambda: Author.objects.prefetch('books_declarative')),
+        ('books-union', 'prefetch', lambda: Author.objects.prefetch('books_declarative', 'latest_book')),
+        ('books-union', 'prefetch+union',
+         lambda: Author.objects.prefetch('books_declarative', 'latest_book').prefetch_union()),
+        ('collect', 'prefetch', lambda: Book.objects.select_related('author').prefetch('similar_books')),
+        ('forwarders', 'prefetch', lambda: Book.objects.prefetch('author__books')),
+        ('forwarders', 'prefetch+identity_map', lambda: Book.objects.prefetch('author__books').prefetch_identity_map()),
+        ('forwarders', 'prefetch_related',
+         lambda: Book.objects.select_related('author').prefetch_related('author__book_set')),
+        ('m2m-through', 'prefetch', lambda: Book.objects.prefetch('tags')),
+        ('m2m-through', 'prefetch_related', lambda: Book.objects.prefetch_related('tags')),
+        ('nested-forwarders', 'prefetch', lambda: BookNote.objects.prefetch('book__tags')),
+        ('nested-forwarders', 'prefetch_related', lambda: BookNote.objects.select_related('book').prefetch_related(
+            'book__tags')),
+        ('many', 'prefetch', lambda: Author.objects.prefetch(
+            'books', 'latest_book', P('latest_n_books', count=3), 'book_stats', 'books__tags')),
+    ]
+    if django.VERSION < (2, 0):
+        # The identity map requires Django 2.0 or later.
+        benchmarks = [benchmark for benchmark in benchmarks if 'identity_map' not in benchmark[1]]
+    return benchmarks
+
+
+def measure(factory, repeat):
+    best = None
+    for _ in range(repeat):
+        start = clock()
+        rows = len(list(factory()))
+        elapsed = clock() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    with CaptureQueriesContext(connection) as context:
+        list(factory())
+    queries = len(context.captured_queries)
+
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            list(factory())
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return rows, best, queries, peak
+
+
+def run(repeat=3, only=None, stream=sys.stdout):
+    results = []
+    print("%-20s %-18s %8s %10s %12s %8s %12s" % (
+        'benchmark', 'implementation', 'rows', 'secs', 'rows/sec', 'queries', 'peak KiB'), file=stream)
+    for name, implementation, factory in get_benchmarks():
+        if only and name not in only:
+            continue
+        rows, best, queries, peak = measure(factory, repeat)
+        results.append((name, implementation, rows, best, queries, peak))
+        print("%-20s %-18s %8s %10.4f %12.0f %8s %12s" % (
+            name, implementation, rows, best, rows / best if best else 0, queries,
+            '-' if peak is None else '%.0f' % (peak / 1024.0)), file=stream)
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--authors', type=int, default=100, help="Number of authors (default: %(default)s).")
+    parser.add_argument('--books-per-author', type=int, default=10, help="Default: %(default)s.")
+    parser.add_argument('--tags', type=int, default=50, help="Number of tags (default: %(default)s).")
+    parser.add_argument('--tags-per-book', type=int, default=3, help="Default: %(default)s.")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the random data (default: %(default)s).")
+    parser.add_argument('--repeat', type=int, default=3, help="Best of how many runs (default: %(default)s).")
+    parser.add_argument('only', nargs='*', help="Only run these benchmarks.")
+    options = parser.parse_args(args)
+
+    django.setup()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        seed(authors=options.authors, books_per_author=options.books_per_author, tags=options.tags,
+             tags_per_book=options.tags_per_book, random_seed=options.seed)
+        run(repeat=options.repeat, only=options.only)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
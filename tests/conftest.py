@@ -0,0 +1,9 @@
+import sys
+
+try:
+    import asgiref  # noqa
+except ImportError:  # Django < 3.0
+    asgiref = None
+
+if asgiref is None or sys.version_info < (3, 6):
+    collect_ignore = ['test_app/test_async.py']
@@ -1,7 +1,12 @@
 from django.db import models
+from django.db.models import Count
+from django.db.models import Max
 
+from prefetch import AggregatePrefetcher
 from prefetch import Prefetcher
 from prefetch import PrefetchManager
+from prefetch import ReverseFK
+from prefetch import TopNPrefetcher
 
 
 class SillyException(Exception):
@@ -9,17 +14,33 @@ class SillyException(Exception):
 
 
 class SillyPrefetcher(Prefetcher):
-    def filter(ids):
+    def filter(self, ids):
         raise SillyException()
 
-    def reverse_mapper(book):
+    def reverse_mapper(self, book):
         raise SillyException()
 
-    def decorator(author, books=()):
+    def decorator(self, author, books=()):
         raise SillyException()
 
 
+class TagsPrefetcher(Prefetcher):
+    def __init__(self, **kwargs):
+        super(TagsPrefetcher, self).__init__(**kwargs)
+
+    def filter(self, ids):
+        return Book.tags.through.objects.select_related('tag').filter(book__in=ids)
+
+    def reverse_mapper(self, book_tag):
+        return [book_tag.book_id]
+
+    def decorator(self, book, book_tags=()):
+        setattr(book, 'prefetched_tags', [i.tag for i in book_tags])
+
+
 class LatestNBooks(Prefetcher):
+    source = 'author_books'
+
     def __init__(self, count=2):
         self.count = count
 
@@ -36,7 +57,30 @@ class LatestNBooks(Prefetcher):
                 books[:self.count])
 
 
+class LatestNBooksRequired(LatestNBooks):
+    def __init__(self, count):
+        super(LatestNBooksRequired, self).__init__(count)
+
+
+class LatestNBooksTop(TopNPrefetcher):
+    model = 'test_app.Book'
+    key = 'author'
+    order_by = ['-created', '-id']
+
+    def decorator(self, author, books=()):
+        setattr(author, 'prefetched_top_%s_books' % self.count, books)
+
+
+class BookStats(AggregatePrefetcher):
+    model = 'test_app.Book'
+    key = 'author'
+    aggregates = {'book_count': Count('pk'), 'last_published': Max('created')}
+    defaults = {'book_count': 0}
+
+
 class LatestBook(Prefetcher):
+    source = 'author_books'
+
     def filter(self, ids):
         return Book.objects.filter(author__in=ids)
 
@@ -60,10 +104,27 @@ class Author(models.Model):
             mapper=lambda author: author.id,
             reverse_mapper=lambda book: [book.author_id],
             decorator=lambda author, books=():
-            setattr(author, 'prefetched_books', books)
+            setattr(author, 'prefetched_books', books),
+            source='author_books',
+            attrs=['prefetched_books'],
         ),
+        books_declarative=ReverseFK('test_app.Book', 'author', to_attr='prefetched_books'),
         latest_n_books=LatestNBooks,
+        latest_n_books_required=LatestNBooksRequired,
         latest_book_as_class=LatestBook,
+        latest_n_books_top=LatestNBooksTop,
+        book_stats=BookStats,
+        books_with_tags=Prefetcher(
+            filter=lambda ids: Book.objects.filter(author__in=ids).prefetch('tags'),
+            reverse_mapper=lambda book: [book.author_id],
+            decorator=lambda author, books=(): setattr(author, 'prefetched_books_with_tags', books),
+        ),
+        book_names=Prefetcher(
+            filter=lambda ids: Book.objects.filter(author__in=ids).order_by('name'),
+            reverse_mapper=lambda book: [book.author_id],
+            decorator=lambda author, books=(): setattr(author, 'prefetched_book_names', [i.name for i in books]),
+            fields=['author_id', 'name'],
+        ),
         latest_book=Prefetcher(
             filter=lambda ids: Book.objects.filter(author__in=ids),
             reverse_mapper=lambda book: [book.author_id],
@@ -71,7 +132,9 @@ class Author(models.Model):
                 author,
                 'prefetched_latest_book',
                 max(books, key=lambda book: book.created) if books else None
-            )
+            ),
+            source='author_books',
+            attrs=['prefetched_latest_book'],
         ),
         silly=SillyPrefetcher,
     )
@@ -120,6 +183,23 @@ class Book(models.Model):
             decorator=lambda user, book_tags=():
             setattr(user, 'prefetched_tags', [i.tag for i in book_tags])
         ),
+        tags_class=TagsPrefetcher,
+        # Same source name as the books of the authors, the queries must not be shared.
+        notes=Prefetcher(
+            filter=lambda ids: BookNote.objects.filter(book__in=ids),
+            reverse_mapper=lambda note: [note.book_id],
+            decorator=lambda book, notes=(): setattr(book, 'prefetched_notes', notes),
+            source='author_books',
+        ),
+        tags_cached=Prefetcher(
+            filter=lambda ids: Book.tags.through.objects.select_related('tag').filter(book__in=ids),
+            reverse_mapper=lambda book_tag: [book_tag.book_id],
+            decorator=lambda user, book_tags=():
+            setattr(user, 'prefetched_tags', [i.tag for i in book_tags]),
+            cache_alias='default',
+            cache_prefix='book_tags',
+            cache_models=['test_app.Book_tags', 'test_app.Tag'],
+        ),
         similar_books=Prefetcher(
             filter=lambda ids: Book.objects.filter(author__in=ids),
             mapper=lambda book: book.author_id,
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import time
+
+from asgiref.sync import sync_to_async
+from django.core.exceptions import SynchronousOnlyOperation
+from django.test import TransactionTestCase
+
+from prefetch import P
+from prefetch import PrefetchCache
+from prefetch import QueryBudgetExceeded
+
+from .models import Author
+from .models import Book
+from .models import SillyException
+from .tests import AssertingHandler
+
+
+class AsyncPrefetchTests(TransactionTestCase):
+    databases = ['default', 'secondary']
+
+    def setUp(self):
+        for i in range(3):
+            author = Author.objects.create(name="Johnny-%s" % i)
+            for j in range(3):
+                Book.objects.create(name="Book %s" % j, author=author)
+                time.sleep(0.01)
+
+    async def test_async_for(self):
+        queryset = Author.objects.prefetch('books', 'latest_book', P('latest_n_books', count=2), 'books__tags')
+        authors = [author async for author in queryset]
+        self.assertEqual(len(authors), 3)
+        for author in authors:
+            self.assertEqual([i.name for i in author.books], ["Book 0", "Book 1", "Book 2"])
+            self.assertEqual(author.latest_book.name, "Book 2")
+            self.assertEqual([i.name for i in author.prefetched_latest_2_books], ["Book 2", "Book 1"])
+            for book in author.books:
+                self.assertEqual(book.selected_tags, [])
+
+        self.assertEqual(queryset._result_cache, authors)
+        self.assertEqual([author async for author in queryset], authors)
+
+        self.assertEqual([name async for name in Author.objects.values_list('name', flat=True).order_by('name')],
+                         ["Johnny-0", "Johnny-1", "Johnny-2"])
+        names = Author.objects.values_list('name', flat=True).order_by('name').aiterator(chunk_size=2)
+        self.assertEqual([name async for name in names], ["Johnny-0", "Johnny-1", "Johnny-2"])
+
+    async def test_aiterator(self):
+        queryset = Author.objects.prefetch('books', 'book_stats').prefetch_workers(1).order_by('id')
+        authors = [author async for author in queryset.aiterator(chunk_size=2)]
+        self.assertEqual([author.name for author in authors], ["Johnny-0", "Johnny-1", "Johnny-2"])
+        self.assertEqual([len(author.books) for author in authors], [3, 3, 3])
+        self.assertEqual([author.book_count for author in authors], [3, 3, 3])
+
+        authors = [author async for author in queryset.expect_queries(3).aiterator()]
+        self.assertEqual(len(authors), 3)
+        with self.assertRaises(QueryBudgetExceeded):
+            [author async for author in queryset.expect_queries(2).aiterator()]
+
+    async def test_afetch(self):
+        authors = [author async for author in Author.objects.all()]
+        prefetcher = Author.objects.prefetch_definitions['books_declarative']
+        await prefetcher.afetch(authors, 'books_declarative', Author, (), None)
+        self.assertEqual([len(author.prefetched_books) for author in authors], [3, 3, 3])
+
+    async def test_async_exception(self):
+        asserting_handler = AssertingHandler(10)
+        logging.getLogger().addHandler(asserting_handler)
+        try:
+            with self.assertRaises(SillyException):
+                [author async for author in Author.objects.prefetch('books', 'silly')]
+            asserting_handler.assertLogged(self, "Prefetch failed for silly prefetch on the Author model:")
+        finally:
+            logging.getLogger().removeHandler(asserting_handler)
+
+    async def test_concurrent_tasks(self):
+        async def evaluate(queryset):
+            return [author async for author in queryset]
+
+        first, second = await asyncio.gather(
+            evaluate(Author.objects.prefetch('books').expect_queries(2)),
+            evaluate(Author.objects.prefetch('books', 'latest_book', 'book_stats').expect_queries(3)),
+        )
+        self.assertEqual([len(author.books) for author in first], [3, 3, 3])
+        self.assertEqual([author.book_count for author in second], [3, 3, 3])
+
+        async def cached(name):
+            with PrefetchCache() as cache:
+                await evaluate(Author.objects.prefetch(name))
+                return [prefetcher for prefetcher, db, nested in cache.data]
+
+        first, second = await asyncio.gather(cached('books'), cached('book_stats'))
+        self.assertEqual(first, [Author.objects.prefetch('books')._prefetch['books'][1]])
+        self.assertEqual(second, [Author.objects.prefetch('book_stats')._prefetch['book_stats'][1]])
+        self.assertIsNone(PrefetchCache.current())
+
+    async def test_lazy(self):
+        authors = [author async for author in Author.objects.prefetch('books').prefetch_lazy().order_by('id')]
+        with self.assertRaises(SynchronousOnlyOperation):
+            authors[0].prefetched_books
+        self.assertEqual(await sync_to_async(lambda: len(authors[0].prefetched_books))(), 3)
+        self.assertEqual([len(author.prefetched_books) for author in authors], [3, 3, 3])
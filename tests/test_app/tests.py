@@ -1,15 +1,37 @@
 import logging
 import logging.handlers
+import operator
+import pickle
 import re
 import time
 import warnings
-
+from unittest import skipIf
+
+import benchmarks
+import django
+from django.core.cache import cache
+from django.db import Error
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.db.models import F
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test import override_settings
 
 from prefetch import InvalidPrefetch
+from prefetch import KeyTable
+from prefetch import MissingPrefetch
+from prefetch import MissingPrefetchDetector
 from prefetch import P
+from prefetch import PrefetchCache
 from prefetch import Prefetcher
 from prefetch import PrefetchManager
+from prefetch import QueryBudget
+from prefetch import QueryBudgetExceeded
+from prefetch import ReverseFK
+from prefetch import prefetch_objects
+from prefetch import prefetched
+from prefetch import union_all
 
 from .models import Author
 from .models import Book
@@ -18,6 +40,11 @@ from .models import LatestBook
 from .models import SillyException
 from .models import Tag
 
+try:
+    from StringIO import StringIO  # Python 2, print writes str there
+except ImportError:
+    from io import StringIO
+
 
 class AssertingHandler(logging.handlers.BufferingHandler):
 
@@ -129,6 +156,119 @@ class PrefetchTests(TestCase):
             self.assertFalse(hasattr(i, 'prefetched_books'))
             self.assertEqual(len(i.books), 3, i.books)
 
+    def test_iterator_chunk_size(self):
+        authors = [Author.objects.create(name="Johnny-%s" % i) for i in range(5)]
+        for author in authors:
+            for i in range(3):
+                Book.objects.create(name="Book %s" % i, author=author)
+
+        with self.assertNumQueries(4):
+            seen = []
+            for i in Author.objects.prefetch('books').order_by('pk').iterator(chunk_size=2):
+                self.assertTrue(hasattr(i, 'prefetched_books'))
+                self.assertEqual(len(i.books), 3, i.books)
+                seen.append(i.pk)
+            self.assertEqual(seen, [author.pk for author in authors])
+
+        with self.assertNumQueries(2):
+            for i in Author.objects.prefetch('books').iterator():
+                self.assertEqual(len(i.books), 3, i.books)
+
+        self.assertRaises(ValueError, Author.objects.prefetch('books').iterator, chunk_size=0)
+
+    def test_batch_size(self):
+        authors = [Author.objects.create(name="Johnny-%s" % i) for i in range(5)]
+        for author in authors:
+            for i in range(3):
+                Book.objects.create(name="Book %s" % i, author=author)
+
+        with override_settings(PREFETCH_BATCH_SIZE=2):
+            with self.assertNumQueries(4):
+                for i in Author.objects.prefetch('books'):
+                    self.assertEqual(len(i.books), 3, i.books)
+
+        prefetcher = Prefetcher(
+            filter=lambda ids: Book.objects.filter(author__in=ids),
+            reverse_mapper=lambda book: [book.author_id],
+            decorator=lambda author, books=(): setattr(author, 'prefetched_books', books),
+            batch_size=3,
+        )
+        data = list(Author.objects.all())
+        with self.assertNumQueries(2):
+            prefetcher.fetch(data, 'books', Author, [], None)
+        for i in data:
+            self.assertEqual(len(i.books), 3, i.books)
+
+    def test_shared_source(self):
+        authors = [Author.objects.create(name="Johnny-%s" % i) for i in range(3)]
+        for author in authors:
+            for i in range(3):
+                Book.objects.create(name="Book %s" % i, author=author)
+                time.sleep(0.01)
+        Author.objects.create(name="John Doe")
+
+        with self.assertNumQueries(2):
+            for i in Author.objects.prefetch('books', 'latest_book', P('latest_n_books', count=2)).exclude(
+                    name="John Doe"):
+                self.assertEqual(len(i.books), 3, i.books)
+                self.assertEqual(i.latest_book.name, "Book 2")
+                self.assertEqual([j.name for j in i.prefetched_latest_2_books], ["Book 2", "Book 1"])
+
+        with self.assertNumQueries(2):
+            for i in Author.objects.prefetch('books', 'latest_book').filter(name="John Doe"):
+                self.assertEqual(i.books, ())
+                self.assertEqual(i.latest_book, None)
+
+    def test_shared_source_other_model(self):
+        author = Author.objects.create(name="Johnny")
+        books = []
+        for i in range(3):
+            books.append(Book.objects.create(name="Book %s" % i, author=author))
+            time.sleep(0.01)
+        BookNote.objects.create(book=books[0], notes="Note")
+
+        # Book.notes has the same source name as Author.books, they can't share a query.
+        with self.assertNumQueries(3):
+            for book in Book.objects.prefetch('author__books', 'author__latest_book', 'notes'):
+                self.assertEqual(len(book.author.books), 3)
+                self.assertEqual(book.author.latest_book.name, "Book 2")
+                self.assertEqual([note.notes for note in book.prefetched_notes], ["Note"] if book == books[0] else [])
+
+    def test_nested(self):
+        tags = [Tag.objects.create(name="Tag %s" % i) for i in range(10)]
+        authors = [Author.objects.create(name="Johnny-%s" % i) for i in range(3)]
+        for author in authors:
+            for i in range(3):
+                book = Book.objects.create(name="Book %s" % i, author=author)
+                book.tags.add(*tags[i::3])
+
+        with self.assertNumQueries(3):
+            for i in Author.objects.prefetch('books__tags', 'books'):
+                self.assertEqual(len(i.books), 3, i.books)
+                for book in i.books:
+                    self.assertTrue(hasattr(book, 'prefetched_tags'))
+                    self.assertEqual(set(book.selected_tags), set(tags[int(book.name[-1])::3]))
+
+        with self.assertNumQueries(4):
+            for book in Book.objects.prefetch('author__books__tags', 'tags'):
+                self.assertEqual(set(book.selected_tags), set(tags[int(book.name[-1])::3]))
+                for similar in book.author.books:
+                    self.assertEqual(set(similar.selected_tags), set(tags[int(similar.name[-1])::3]))
+
+        with self.assertNumQueries(3):
+            for i in Author.objects.prefetch('books__author__latest_book', P('books__author__latest_n_books', count=1)):
+                for book in i.books:
+                    self.assertEqual(book.author.latest_book, book.author.prefetched_latest_1_books[0])
+
+        # The options are for the first prefetcher that takes them.
+        with self.assertNumQueries(3):
+            for i in Author.objects.prefetch(P('latest_n_books_required__tags', count=1)):
+                for book in i.prefetched_latest_1_books:
+                    self.assertEqual(set(book.selected_tags), set(tags[int(book.name[-1])::3]))
+        self.assertRaises(TypeError, Author.objects.prefetch, 'latest_n_books_required__tags')
+        with self.assertRaises(InvalidPrefetch):
+            Author.objects.prefetch(P('latest_n_books_required__tgas', count=1))
+
     def test_latest_n_books(self):
         author1 = Author.objects.create(name="Johnny")
         for i in range(20, 30):
@@ -163,6 +303,626 @@ class PrefetchTests(TestCase):
                 ["Book 29", "Book 28", "Book 27", "Book 26", "Book 25"]
             )
 
+    def test_top_n_books(self):
+        author1 = Author.objects.create(name="Johnny")
+        author2 = Author.objects.create(name="Johnny")
+        author3 = Author.objects.create(name="Johnny")
+        for i in range(10):
+            Book.objects.create(name="Book %s" % i, author=author1)
+            Book.objects.create(name="Other Book %s" % i, author=author2)
+
+        with self.assertNumQueries(2):
+            authors = list(Author.objects.prefetch('latest_n_books_top').order_by('pk'))
+        self.assertEqual([j.name for j in authors[0].prefetched_top_1_books], ["Book 9"])
+        self.assertEqual([j.name for j in authors[1].prefetched_top_1_books], ["Other Book 9"])
+        self.assertEqual(authors[2].prefetched_top_1_books, ())
+
+        with self.assertNumQueries(2):
+            authors = list(Author.objects.prefetch(P('latest_n_books_top', count=3)).filter(
+                pk__in=[author1.pk, author3.pk]).order_by('pk'))
+        self.assertEqual([j.name for j in authors[0].prefetched_top_3_books], ["Book 9", "Book 8", "Book 7"])
+        self.assertEqual(authors[1].prefetched_top_3_books, ())
+
+    def test_aggregate(self):
+        author1 = Author.objects.create(name="Johnny")
+        author2 = Author.objects.create(name="Johnny")
+        for i in range(3):
+            Book.objects.create(name="Book %s" % i, author=author1)
+        latest = Book.objects.create(name="Book 3", author=author1)
+
+        with self.assertNumQueries(2):
+            authors = list(Author.objects.prefetch('book_stats').order_by('pk'))
+        self.assertEqual(authors[0].book_count, 4)
+        self.assertEqual(authors[0].last_published, latest.created)
+        self.assertEqual(authors[1].book_count, 0)
+        self.assertEqual(authors[1].last_published, None)
+        self.assertEqual([author.pk for author in authors], [author1.pk, author2.pk])
+
+    def test_fields(self):
+        author = Author.objects.create(name="Johnny")
+        for i in range(3):
+            Book.objects.create(name="Book %s" % i, author=author)
+
+        with self.assertNumQueries(2) as context:
+            authors = list(Author.objects.prefetch('book_names'))
+        self.assertEqual(authors[0].prefetched_book_names, ["Book 0", "Book 1", "Book 2"])
+        self.assertNotIn('"test_app_book"."created"', context.captured_queries[1]['sql'])
+
+        with self.assertRaises(InvalidPrefetch):
+            list(Author.objects.prefetch('book_names__tags'))
+
+    def test_reverse_fk(self):
+        author1 = Author.objects.create(name="Johnny")
+        Author.objects.create(name="Johnny")
+        for i in range(3):
+            Book.objects.create(name="Book %s" % i, author=author1)
+
+        with self.assertNumQueries(2):
+            declarative = list(Author.objects.prefetch('books_declarative').order_by('pk'))
+        handwritten = list(Author.objects.prefetch('books').order_by('pk'))
+        self.assertEqual([i.prefetched_books for i in declarative], [i.prefetched_books for i in handwritten])
+        self.assertEqual(len(declarative[0].books), 3)
+        self.assertEqual(declarative[1].books, ())
+
+        with self.assertNumQueries(2):
+            for book in Book.objects.prefetch('author__books_declarative'):
+                self.assertEqual(len(book.author.books), 3)
+
+        with self.assertRaises(InvalidPrefetch):
+            Author.objects.prefetch(P('books_declarative'))
+
+        PrefetchManager(books=ReverseFK(Book, 'author', to_attr='books'))
+        self.assertRaises(RuntimeError, ReverseFK, Book, None, to_attr='books')
+
+        prefetcher = ReverseFK(Book, 'author', to_attr='prefetched_books', related_key_attr='author_id')
+        self.assertEqual(prefetcher.related_key_attr, 'author_id')
+        self.assertEqual(ReverseFK(Book, 'author', to_attr='books').related_key_attr, 'author_id')
+        authors = list(Author.objects.order_by('pk'))
+        with self.assertNumQueries(1):
+            prefetcher.fetch(authors, 'books', Author, (), None)
+        self.assertEqual([len(i.prefetched_books) for i in authors], [len(i.books) for i in handwritten])
+
+    def test_plan_cache(self):
+        first = Book.objects.prefetch('author__latest_book_as_class', 'tags')
+        second = Book.objects.prefetch('author__latest_book_as_class', P('author__latest_n_books', count=3))
+        self.assertIs(first._prefetch['author__latest_book_as_class'][1],
+                      second._prefetch['author__latest_book_as_class'][1])
+        self.assertEqual(first._prefetch['author__latest_book_as_class'][0], ('author',))
+        self.assertIsNot(second._prefetch['author__latest_n_books'][1],
+                         Book.objects.prefetch(P('author__latest_n_books', count=3))._prefetch['author__latest_n_books'][1])
+
+        for _ in range(2):
+            with self.assertRaises(InvalidPrefetch) as cm:
+                Book.objects.prefetch('author__asdf')
+            self.assertEqual(cm.exception.args, (
+                "Invalid part asdf in prefetch call for author__asdf on model <class 'test_app.models.Book'>. The "
+                "name is not a prefetcher nor a forward relation (fk).",))
+
+    def test_prefetch_objects(self):
+        author1 = Author.objects.create(name="Johnny")
+        author2 = Author.objects.create(name="Johnny")
+        for i in range(3):
+            Book.objects.create(name="Book %s" % i, author=author1)
+            time.sleep(0.01)
+
+        with self.assertNumQueries(1):
+            prefetch_objects([author1, author2], 'books', P('latest_n_books', count=2))
+        self.assertEqual(len(author1.books), 3)
+        self.assertEqual([i.name for i in author1.prefetched_latest_2_books], ["Book 2", "Book 1"])
+        self.assertEqual(author2.books, ())
+
+        books = list(Book.objects.select_related('author'))
+        with self.assertNumQueries(1):
+            prefetch_objects(iter(books), 'author__books')
+        for book in books:
+            self.assertEqual(len(book.author.books), 3)
+
+        with self.assertNumQueries(0):
+            prefetch_objects([], 'books')
+
+        with self.assertRaises(InvalidPrefetch):
+            prefetch_objects([Tag.objects.create(name="Tag")], 'books')
+
+    def test_prefetch_cache(self):
+        author1 = Author.objects.create(name="Johnny")
+        author2 = Author.objects.create(name="Johnny")
+        for i in range(3):
+            Book.objects.create(name="Book %s" % i, author=author1)
+            Book.objects.create(name="Other Book %s" % i, author=author2)
+
+        with PrefetchCache() as cache:
+            with self.assertNumQueries(2):
+                for i in Author.objects.prefetch('books').filter(pk=author1.pk):
+                    self.assertEqual(len(i.books), 3)
+            with self.assertNumQueries(2) as context:
+                for i in Author.objects.prefetch('books'):
+                    self.assertEqual(len(i.books), 3)
+            self.assertIn('IN (%s)' % author2.pk, context.captured_queries[1]['sql'])
+            with self.assertNumQueries(1):
+                for i in Author.objects.prefetch('books').prefetch_workers(2):
+                    self.assertEqual(len(i.books), 3)
+            self.assertIs(PrefetchCache.current(), cache)
+
+        self.assertIs(PrefetchCache.current(), None)
+        self.assertEqual(cache.data, {})
+        with self.assertNumQueries(2):
+            for i in Author.objects.prefetch('books'):
+                self.assertEqual(len(i.books), 3)
+
+    def test_cache_rows_of_several_keys(self):
+        cache.clear()
+        tags = [Tag.objects.create(name="Tag %s" % i) for i in range(2)]
+        Book.objects.create(name="Book", author=Author.objects.create(name="Johnny")).tags.add(*tags)
+
+        def get_prefetcher(**kwargs):
+            # The same book is in the rows of every tag it has.
+            return Prefetcher(
+                filter=lambda ids: Book.objects.filter(tags__in=ids).annotate(tag_id=F('tags')),
+                reverse_mapper=lambda book: [book.tag_id],
+                decorator=lambda tag, books=(): setattr(tag, 'prefetched_books', books),
+                **kwargs
+            )
+
+        for prefetcher in get_prefetcher(), get_prefetcher(cache_alias='default', cache_prefix='tag_books',
+                                                           cache_models=['test_app.Book_tags']):
+            for _ in range(2):
+                with PrefetchCache():
+                    prefetcher.fetch(tags, 'books', Tag, (), None)
+                self.assertEqual([[book.name for book in tag.prefetched_books] for tag in tags], [["Book"], ["Book"]])
+
+    @skipIf(django.VERSION < (3, 2), "The test needs TestCase.captureOnCommitCallbacks (Django 3.2 or later).")
+    def test_cache_alias(self):
+        cache.clear()
+        tags = [Tag.objects.create(name="Tag %s" % i) for i in range(3)]
+        author = Author.objects.create(name="Johnny")
+        book1 = Book.objects.create(name="Book 1", author=author)
+        book2 = Book.objects.create(name="Book 2", author=author)
+        book1.tags.add(*tags[:2])
+
+        with self.assertNumQueries(2):
+            books = list(Book.objects.prefetch('tags_cached').order_by('pk'))
+        self.assertEqual([set(i.selected_tags) for i in books], [set(tags[:2]), set()])
+
+        with self.assertNumQueries(1):
+            books = list(Book.objects.prefetch('tags_cached').order_by('pk'))
+        self.assertEqual([set(i.selected_tags) for i in books], [set(tags[:2]), set()])
+
+        book3 = Book.objects.create(name="Book 3", author=author)
+        with self.assertNumQueries(2) as context:
+            books = list(Book.objects.prefetch('tags_cached').order_by('pk'))
+        self.assertIn('IN (%s)' % book3.pk, context.captured_queries[1]['sql'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            book2.tags.add(tags[2])
+        with self.assertNumQueries(2):
+            books = list(Book.objects.prefetch('tags_cached').order_by('pk'))
+        self.assertEqual([set(i.selected_tags) for i in books], [set(tags[:2]), {tags[2]}, set()])
+
+        Tag.objects.filter(pk=tags[2].pk).update(name="Stale")
+        with self.assertNumQueries(1):
+            books = list(Book.objects.prefetch('tags_cached').order_by('pk'))
+        self.assertEqual(books[1].selected_tags[0].name, "Tag 2")
+
+        tags[2].name = "Renamed"
+        with self.captureOnCommitCallbacks() as callbacks:
+            tags[2].save()
+        # Not invalidated until the transaction commits.
+        with self.assertNumQueries(1):
+            books = list(Book.objects.prefetch('tags_cached').order_by('pk'))
+        for callback in callbacks:
+            callback()
+        with self.assertNumQueries(2):
+            books = list(Book.objects.prefetch('tags_cached').order_by('pk'))
+        self.assertEqual(books[1].selected_tags[0].name, "Renamed")
+
+        options = P('tags_class', cache_alias='default', cache_prefix='book_tags_class', cache_models=['test_app.Tag'])
+        with self.assertNumQueries(2):
+            books = list(Book.objects.prefetch(options).order_by('pk'))
+        with self.assertNumQueries(1):
+            books = list(Book.objects.prefetch(options).order_by('pk'))
+        self.assertEqual(books[1].selected_tags[0].name, "Renamed")
+        tags[2].name = "Renamed again"
+        with self.captureOnCommitCallbacks(execute=True):
+            tags[2].save()
+        with self.assertNumQueries(2):
+            books = list(Book.objects.prefetch(options).order_by('pk'))
+        self.assertEqual(books[1].selected_tags[0].name, "Renamed again")
+
+    def test_cache_alias_misconfigured(self):
+        def get_prefetcher(**kwargs):
+            return Prefetcher(
+                filter=lambda ids: Book.tags.through.objects.filter(book__in=ids),
+                reverse_mapper=lambda book_tag: [book_tag.book_id],
+                decorator=lambda user, book_tags=(): None,
+                cache_alias='default',
+                **kwargs
+            )
+
+        self.assertRaises(RuntimeError, PrefetchManager, tags=get_prefetcher(cache_models=['test_app.Tag']))
+        self.assertRaises(RuntimeError, PrefetchManager, tags=get_prefetcher(cache_prefix='book_tags'))
+        self.assertRaises(RuntimeError, Book.objects.prefetch,
+                          P('tags_class', cache_alias='default', cache_prefix='book_tags_class'))
+
+    def test_prefetch_objects_incremental(self):
+        authors = [Author.objects.create(name="Johnny-%s" % i) for i in range(4)]
+        for author in authors:
+            for i in range(2):
+                Book.objects.create(name="Book %s" % i, author=author)
+        first_page = list(Author.objects.filter(pk__in=[i.pk for i in authors[:2]]))
+        next_page = list(Author.objects.filter(pk__in=[i.pk for i in authors[2:]]))
+
+        with self.assertNumQueries(2):
+            prefetch_objects(first_page, 'books', 'book_stats', incremental=True)
+        with self.assertNumQueries(0):
+            prefetch_objects(first_page, 'books', incremental=True)
+        with self.assertNumQueries(2) as context:
+            prefetch_objects(first_page + next_page, 'books', 'book_stats', incremental=True)
+        self.assertIn('IN (%s, %s)' % (authors[2].pk, authors[3].pk), context.captured_queries[0]['sql'])
+        for author in first_page + next_page:
+            self.assertEqual(len(author.books), 2)
+            self.assertEqual(author.book_count, 2)
+
+        with self.assertNumQueries(1):
+            prefetch_objects(first_page + next_page, 'books')
+
+        books = list(Book.objects.select_related('author'))
+        with self.assertNumQueries(1):
+            prefetch_objects(books, 'author__books', incremental=True)
+        with self.assertNumQueries(0):
+            prefetch_objects(books, 'author__books', incremental=True)
+
+        self.assertRaises(TypeError, prefetch_objects, books, 'author__books', incremntal=True)
+
+        with self.assertNumQueries(1):
+            prefetch_objects(first_page, P('latest_n_books', count=1), incremental=True)
+        with self.assertNumQueries(0):
+            prefetch_objects(first_page, P('latest_n_books', count=1), incremental=True)
+        with self.assertNumQueries(1):
+            prefetch_objects(first_page, P('latest_n_books', count=2), incremental=True)
+
+        authors = pickle.loads(pickle.dumps(first_page + next_page))
+        with self.assertNumQueries(0):
+            prefetch_objects(authors, 'books', 'book_stats', incremental=True)
+        self.assertEqual([len(author.books) for author in authors], [2, 2, 2, 2])
+
+    def test_prefetch_lazy(self):
+        authors = [Author.objects.create(name="Johnny-%s" % i) for i in range(3)]
+        for author in authors[:2]:
+            for i in range(2):
+                Book.objects.create(name="Book %s" % i, author=author)
+
+        with self.assertNumQueries(1):
+            authors = list(Author.objects.prefetch('books', 'latest_book', 'book_stats').prefetch_lazy().order_by('pk'))
+        with self.assertNumQueries(1):
+            self.assertEqual(len(authors[0].books), 2)
+            self.assertEqual(len(authors[1].books), 2)
+            self.assertEqual(authors[2].books, ())
+        with self.assertNumQueries(1):
+            self.assertEqual([i.book_count for i in authors], [2, 2, 0])
+
+        with self.assertNumQueries(2):
+            for book in Book.objects.prefetch('author__books_declarative').prefetch_lazy():
+                self.assertEqual(len(book.author.books), 2)
+
+        with self.assertNumQueries(2):
+            for i in Author.objects.filter(pk=authors[0].pk):
+                self.assertFalse(hasattr(i, 'prefetched_books'))
+                self.assertEqual(len(i.books), 2)
+
+        with self.assertRaises(InvalidPrefetch):
+            list(Author.objects.prefetch('latest_n_books').prefetch_lazy())
+
+        authors = list(Author.objects.prefetch('books_declarative').prefetch_lazy().order_by('pk'))
+        copies = pickle.loads(pickle.dumps(authors))
+        self.assertEqual([i.name for i in copies], [i.name for i in authors])
+        for author in copies:
+            self.assertFalse(hasattr(author, 'prefetched_books'))
+        with self.assertNumQueries(1):
+            self.assertEqual([len(i.prefetched_books) for i in authors], [2, 2, 0])
+        authors = pickle.loads(pickle.dumps(authors))
+        with self.assertNumQueries(0):
+            self.assertEqual([len(i.prefetched_books) for i in authors], [2, 2, 0])
+
+    def test_missing_prefetch_detector(self):
+        for i in range(3):
+            author = Author.objects.create(name="Johnny-%s" % i)
+            Book.objects.create(name="Book %s" % i, author=author)
+
+        attributes = {model: dict(vars(model)) for model in (Author, Book)}
+        with self.assertRaises(MissingPrefetch) as cm:
+            with MissingPrefetchDetector():
+                for i in Author.objects.all():
+                    self.assertEqual(len(i.books), 1)
+        self.assertEqual({model: dict(vars(model)) for model in (Author, Book)}, attributes)
+        self.assertEqual(cm.exception.args, ("Missing prefetches: Author.objects.prefetch('books') (used on 3 objects)",))
+
+        with MissingPrefetchDetector() as detector:
+            for i in Author.objects.prefetch('books'):
+                self.assertEqual(len(i.books), 1)
+            self.assertEqual(len(Author.objects.first().books), 1)
+        self.assertEqual(detector.get_missing(), {})
+
+        asserting_handler = AssertingHandler(10)
+        logging.getLogger().addHandler(asserting_handler)
+        try:
+            with MissingPrefetchDetector(threshold=3, raise_errors=False):
+                for book in Book.objects.select_related('author'):
+                    self.assertEqual(book.author.latest_book, book)
+            asserting_handler.assertLogged(
+                self, "Missing prefetches: Author.objects.prefetch('latest_book') (used on 3 objects)")
+        finally:
+            logging.getLogger().removeHandler(asserting_handler)
+
+    def test_missing_prefetch_detector_lazy(self):
+        author = Author.objects.create(name="Johnny")
+        Book.objects.create(name="Book", author=author)
+        with MissingPrefetchDetector():
+            authors = list(Author.objects.prefetch('books').prefetch_lazy())
+        self.assertEqual(len(authors[0].prefetched_books), 1)
+
+    def test_prefetched_signal(self):
+        authors = [Author.objects.create(name="Johnny-%s" % i) for i in range(3)]
+        for i in range(4):
+            Book.objects.create(name="Book %s" % i, author=authors[0])
+        Book.objects.create(name="Book", author=authors[1])
+
+        events = []
+
+        def receiver(sender, **kwargs):
+            events.append(dict(kwargs, sender=sender))
+
+        prefetched.connect(receiver)
+        try:
+            list(Author.objects.prefetch('books'))
+            list(Author.objects.prefetch('books', 'latest_book'))
+        finally:
+            prefetched.disconnect(receiver)
+
+        # The prefetchers of a call run in no particular order on Python 2.
+        self.assertEqual(sorted([(i['sender'], i['name'], i['parents'], i['keys'], i['related']) for i in events],
+                                key=operator.itemgetter(1)), [
+            (Author, 'books', 3, 3, 5),
+            (Author, 'books', 3, 3, 5),
+            (Author, 'latest_book', 3, 3, 5),
+        ])
+        for event in events:
+            self.assertIsInstance(event['prefetcher'], Prefetcher)
+            for phase in ('mapping_time', 'query_time', 'decorate_time'):
+                self.assertGreaterEqual(event[phase], 0)
+        self.assertEqual(events[1]['query_time'], events[2]['query_time'])
+
+    def test_prefetch_union(self):
+        for i in range(3):
+            author = Author.objects.create(name="Johnny-%s" % i)
+            for j in range(i):
+                Book.objects.create(name="Book %s" % j, author=author)
+                time.sleep(0.01)
+
+        def get_results(queryset):
+            return [
+                (author.name, [book.name for book in author.prefetched_books], getattr(author.latest_book, 'name', None),
+                 author.prefetched_book_names, [book.name for book in author.prefetched_top_1_books])
+                for author in queryset.order_by('id')
+            ]
+
+        queryset = Author.objects.prefetch('books_declarative', 'latest_book', 'book_names', 'latest_n_books_top')
+        with self.assertNumQueries(5):
+            expected = get_results(queryset)
+        # book_names (fields) and latest_n_books_top (window function) can't be combined.
+        with self.assertNumQueries(4) as context:
+            self.assertEqual(get_results(queryset.prefetch_union()), expected)
+        self.assertIn('UNION ALL', context.captured_queries[1]['sql'])
+        with self.assertNumQueries(5):
+            self.assertEqual(get_results(queryset.prefetch_union().prefetch_union(False)), expected)
+        with self.assertNumQueries(5), PrefetchCache():
+            self.assertEqual(get_results(queryset.prefetch_union()), expected)
+
+        authors = list(Author.objects.order_by('id'))
+        results, _ = union_all([Book.objects.filter(author=author).order_by('-created') for author in authors])
+        self.assertEqual([[book.name for book in books] for books in results], [[], ["Book 0"], ["Book 1", "Book 0"]])
+        self.assertFalse(hasattr(results[2][0], 'prefetch_union_index'))
+
+        # Querysets with prefetches of their own aren't combined.
+        Book.objects.get(name="Book 0", author=authors[1]).tags.add(Tag.objects.create(name="Tag"))
+        for names in [('books_declarative', 'books_with_tags'), ('books_with_tags', 'books_declarative')]:
+            with self.assertNumQueries(4):
+                authors = list(Author.objects.prefetch(*names).prefetch_union().order_by('id'))
+            self.assertEqual([[[tag.name for tag in book.prefetched_tags] for book in author.prefetched_books_with_tags]
+                              for author in authors], [[], [["Tag"]], [[], []]])
+            for author in authors:
+                for book in author.prefetched_books:
+                    self.assertFalse(hasattr(book, 'prefetched_tags'))
+
+    def test_key_table(self):
+        for i in range(4):
+            author = Author.objects.create(name="Johnny-%s" % i)
+            for j in range(i):
+                book = Book.objects.create(name="Book %s" % j, author=author)
+                book.tags.add(Tag.objects.create(name="Tag %s" % j))
+
+        def get_results(queryset):
+            return [
+                (author.name, [(book.name, book.selected_tags) for book in author.books], author.book_count,
+                 [book.name for book in author.prefetched_top_2_books])
+                for author in queryset
+            ]
+
+        queryset = Author.objects.prefetch('books', 'books__tags', 'book_stats', P('latest_n_books_top', count=2))
+        expected = get_results(queryset.order_by('id'))
+        with override_settings(PREFETCH_KEY_TABLE_THRESHOLD=2):
+            with self.assertNumQueries(1 + 4 * 4) as context:
+                self.assertEqual(get_results(queryset.order_by('id')), expected)
+            self.assertIn('CREATE TEMPORARY TABLE', context.captured_queries[1]['sql'])
+            # Same queries with less keys.
+            with self.assertNumQueries(1 + 4 * 4):
+                self.assertEqual(get_results(queryset.filter(name__in=["Johnny-1", "Johnny-2", "Johnny-3"]).order_by('id')),
+                                 expected[1:])
+            # Only the books have more keys than the threshold for the tags.
+            with self.assertNumQueries(1 + 1 + 4 + 1 + 1):
+                self.assertEqual(get_results(queryset.filter(name__in=["Johnny-0", "Johnny-3"]).order_by('id')),
+                                 [expected[0], expected[3]])
+
+        prefetcher = ReverseFK('test_app.Book', 'author', to_attr='prefetched_books', key_table_threshold=1)
+        authors = list(Author.objects.order_by('id'))
+        with self.assertNumQueries(4):
+            prefetcher.fetch(authors, 'books', Author, (), None)
+        self.assertEqual([len(author.prefetched_books) for author in authors], [0, 1, 2, 3])
+
+        # The table is dropped even if loading the keys fails.
+        table = KeyTable(["Johnny", object()])
+        with self.assertRaises(Error):
+            with table.loaded(connection):
+                pass
+        table.keys = ["Johnny"]
+        with table.loaded(connection):
+            pass
+
+    def test_key_attrs(self):
+        authors = [Author.objects.create(name="Johnny-%s" % i) for i in range(3)]
+        for author in authors[:2]:
+            for i in range(2):
+                Book.objects.create(name="Book %s" % i, author=author)
+
+        prefetcher = Prefetcher(
+            filter=lambda ids: Book.objects.filter(author__in=ids),
+            decorator=lambda author, books=(): setattr(author, 'prefetched_books', books),
+            key_attr='id',
+            related_key_attr='author_id',
+        )
+        data = list(Author.objects.order_by('id'))
+        with self.assertNumQueries(1):
+            prefetcher.fetch(data, 'books', Author, (), None)
+        self.assertEqual([len(author.prefetched_books) for author in data], [2, 2, 0])
+
+        self.assertRaises(RuntimeError, Prefetcher, filter=prefetcher.filter, decorator=prefetcher.decorator)
+
+        class PairsPrefetcher(Prefetcher):
+            def filter(self, ids):
+                return Book.objects.filter(author__in=ids).values_list('author_id', 'name')
+
+            def mapper_many(self, objs):
+                return [obj.pk for obj in objs]
+
+            def reverse_mapper_many(self, rows):
+                return ((author_id, name) for author_id, name in rows)
+
+            def decorator(self, author, names=()):
+                author.book_names = sorted(names)
+
+        PairsPrefetcher().fetch(data, 'book_names', Author, (), None)
+        self.assertEqual([author.book_names for author in data], [["Book 0", "Book 1"], ["Book 0", "Book 1"], []])
+
+    def test_decorator_called_once(self):
+        authors = [Author.objects.create(name="Johnny-%s" % i) for i in range(3)]
+        for author in authors[:2]:
+            for i in range(2):
+                Book.objects.create(name="Book %s" % i, author=author)
+        calls = []
+
+        def decorator(author, books=None):
+            calls.append(author.pk)
+            author.prefetched_books = books or []
+
+        prefetcher = Prefetcher(
+            filter=lambda ids: Book.objects.filter(author__in=ids),
+            reverse_mapper=lambda book: [book.author_id],
+            decorator=decorator,
+        )
+        data = list(Author.objects.order_by('id'))
+        prefetcher.fetch(data, 'books', Author, (), None)
+        self.assertEqual(sorted(calls), [author.pk for author in authors])
+        self.assertEqual([len(author.prefetched_books) for author in data], [2, 2, 0])
+
+        del calls[:]
+        books = list(Book.objects.select_related('author'))
+        prefetcher.fetch(books, 'author__books', Book, ('author',), None)
+        self.assertEqual(sorted(calls), sorted(book.author_id for book in books))
+        self.assertEqual([len(book.author.prefetched_books) for book in books], [2, 2, 2, 2])
+
+    @skipIf(django.VERSION < (2, 0), "The identity map requires Django 2.0 or later.")
+    def test_prefetch_identity_map(self):
+        authors = [Author.objects.create(name="Johnny-%s" % i) for i in range(2)]
+        for author in authors:
+            for i in range(3):
+                Book.objects.create(name="Book %s" % i, author=author)
+
+        with self.assertNumQueries(2):
+            books = list(Book.objects.prefetch('author__books').prefetch_identity_map().order_by('id'))
+        self.assertEqual(len(books), 6)
+        self.assertEqual(len({id(book.author) for book in books}), 2)
+        for book in books:
+            self.assertIs(book.author, books[0 if book.author_id == authors[0].pk else 3].author)
+            self.assertEqual([i.name for i in book.author.books], ["Book 0", "Book 1", "Book 2"])
+
+        books = list(Book.objects.prefetch('author__books').order_by('id'))
+        self.assertEqual(len({id(book.author) for book in books}), 6)
+
+        with self.assertNumQueries(2):
+            for book in Book.objects.select_related('author').prefetch('similar_books').prefetch_identity_map():
+                self.assertEqual(len(book.similar_books), 2)
+
+        books = list(Book.objects.prefetch('author__books').prefetch_identity_map().order_by('id').iterator(4))
+        self.assertEqual(len({id(book.author) for book in books}), 3)
+        self.assertEqual([len(book.author.books) for book in books], [3] * 6)
+
+    def test_prefetch_workers_in_transaction(self):
+        for i in range(3):
+            Book.objects.create(name="Book %s" % i, author=Author.objects.create(name="Johnny-%s" % i))
+
+        # The workers wouldn't see the rows of the test transaction, the queries run in this thread instead.
+        with self.assertNumQueries(3):
+            authors = list(Author.objects.prefetch('books', 'book_stats').prefetch_workers(2))
+        self.assertEqual([len(author.books) for author in authors], [1, 1, 1])
+        self.assertEqual([author.book_count for author in authors], [1, 1, 1])
+
+    @skipIf(django.VERSION < (2, 0), "Query budgets require Django 2.0 or later.")
+    def test_expect_queries(self):
+        for i in range(3):
+            author = Author.objects.create(name="Johnny-%s" % i)
+            book = Book.objects.create(name="Book %s" % i, author=author)
+            book.tags.add(Tag.objects.create(name="Tag %s" % i))
+
+        authors = list(Author.objects.prefetch('books', 'books__tags', 'latest_book').expect_queries(4))
+        self.assertEqual(len(authors), 3)
+        self.assertEqual(len(list(Author.objects.prefetch('books').expect_queries(None))), 3)
+
+        with self.assertRaises(QueryBudgetExceeded) as context:
+            list(Author.objects.prefetch('books', 'books__tags').expect_queries(2))
+        self.assertIn("Evaluating a Author queryset made 3 queries, expected at most 2:\n1. SELECT",
+                      str(context.exception))
+
+        with override_settings(PREFETCH_BATCH_SIZE=1), self.assertRaises(QueryBudgetExceeded):
+            list(Author.objects.prefetch('books').expect_queries(3))
+
+        queryset = Author.objects.prefetch('books').expect_queries(2)
+        self.assertEqual(len(list(queryset.iterator(chunk_size=1))), 3)
+        self.assertEqual(len(list(queryset.filter(name="Johnny-1"))), 1)
+
+        self.assertRaises(ValueError, Author.objects.prefetch('books').expect_queries, -1)
+
+    @skipIf(django.VERSION < (2, 0), "Query budgets require Django 2.0 or later.")
+    def test_query_budget(self):
+        Book.objects.create(name="Book", author=Author.objects.create(name="Johnny"))
+        with QueryBudget(2) as budget:
+            list(Author.objects.prefetch('books', 'latest_book'))
+        self.assertEqual(len(budget.queries), 2)
+
+        with self.assertRaises(QueryBudgetExceeded) as context:
+            with QueryBudget(1, "Listing authors"):
+                for author in Author.objects.all():
+                    list(author.book_set.all())
+        self.assertIn("Listing authors made 2 queries, expected at most 1", str(context.exception))
+
+    def test_benchmarks(self):
+        benchmarks.seed(authors=3, books_per_author=2, tags=5, tags_per_book=2)
+        stream = StringIO()
+        results = benchmarks.run(repeat=1, stream=stream)
+        self.assertEqual(len(results), len(benchmarks.get_benchmarks()))
+        self.assertIn('rows/sec', stream.getvalue())
+        for name, implementation, rows, best, queries, peak in results:
+            self.assertEqual(rows, 3 if name.startswith(('authors', 'books', 'many')) else 6, name)
+            self.assertLessEqual(queries, 5, name)
+
     def test_clone(self):
         Author.objects.all()._clone()
 
@@ -365,6 +1125,31 @@ class PrefetchTests(TestCase):
             "Invalid part asdf in prefetch call for books__asdf on model <class 'test_app.models.Author'>. You cannot "
             "have any more relations after the prefetcher.",))
 
+    def test_wrong_nested_prefetch(self):
+        with self.assertRaises(InvalidPrefetch) as cm:
+            Book.objects.prefetch('tags__asdf')
+
+        self.assertRegexpMatches(cm.exception.args[0],
+                                 r"Invalid nested prefetch call with asdf on <prefetch\.Prefetcher object at 0x\w+>\. "
+                                 r"The filter needs to return a PrefetchQuerySet\.")
+
+    def test_wrong_nested_prefetch_deeper(self):
+        with self.assertRaises(InvalidPrefetch) as cm:
+            Author.objects.prefetch('books__tgas')
+        self.assertIn("Invalid part tgas in prefetch call for books__tgas", cm.exception.args[0])
+
+        with self.assertRaises(InvalidPrefetch) as cm:
+            Author.objects.prefetch('books__author__asdf')
+        self.assertEqual(cm.exception.args, (
+            "Invalid part asdf in prefetch call for author__asdf on model <class 'test_app.models.Book'>. The name "
+            "is not a prefetcher nor a forward relation (fk).",))
+
+        with self.assertRaises(InvalidPrefetch) as cm:
+            Author.objects.prefetch('book_names__tags')
+        self.assertIn("Nested prefetches need model instances, they cannot be used with fields.", cm.exception.args[0])
+
+        self.assertEqual(list(Author.objects.prefetch('books__tags', 'books__author__books')), [])
+
     def test_wrong_prefetch_fwd_no_manager(self):
         with self.assertRaises(InvalidPrefetch) as cm:
             Book.objects.prefetch('publisher__whatev')
@@ -408,3 +1193,61 @@ class PrefetchTests(TestCase):
                                        "Prefetch failed for silly prefetch on the Author model:\nTraceback (most "
                                        "recent call last):")
         logging.getLogger().removeHandler(asserting_handler)
+
+
+class PrefetchWorkersTests(TransactionTestCase):
+    databases = ['default', 'secondary']
+
+    def test_prefetch_workers(self):
+        authors = [Author.objects.create(name="Johnny-%s" % i) for i in range(5)]
+        for author in authors:
+            for i in range(3):
+                Book.objects.create(name="Book %s" % i, author=author)
+                time.sleep(0.01)
+
+        for i in Author.objects.prefetch('books', 'latest_book', P('latest_n_books', count=2)).prefetch_workers(2):
+            self.assertEqual(len(i.books), 3, i.books)
+            self.assertEqual(i.latest_book.name, "Book 2")
+            self.assertEqual([j.name for j in i.prefetched_latest_2_books], ["Book 2", "Book 1"])
+
+        # Older Django versions don't flush the secondary database between the tests, don't assume it's empty.
+        for i in Author.objects.prefetch('books').prefetch_workers(2).using('secondary'):
+            self.assertEqual(len(i.books), Book.objects.using('secondary').filter(author=i).count())
+
+    def test_prefetch_workers_exception(self):
+        Author.objects.create(name="John Doe")
+
+        asserting_handler = AssertingHandler(10)
+        logging.getLogger().addHandler(asserting_handler)
+        try:
+            self.assertRaises(SillyException, lambda: list(Author.objects.prefetch('books', 'silly').prefetch_workers(2)))
+            asserting_handler.assertLogged(self, "Prefetch failed for silly prefetch on the Author model:")
+        finally:
+            logging.getLogger().removeHandler(asserting_handler)
+
+    @skipIf(django.VERSION < (2, 0), "Query budgets require Django 2.0 or later.")
+    def test_prefetch_workers_query_budget(self):
+        Book.objects.create(name="Book", author=Author.objects.create(name="Johnny"))
+
+        queryset = Author.objects.prefetch('books', 'latest_book', 'book_stats').prefetch_workers(2)
+        self.assertEqual(len(list(queryset.expect_queries(3))), 1)
+        self.assertRaises(QueryBudgetExceeded, lambda: list(queryset.expect_queries(2)))
+
+    def test_prefetch_workers_connections(self):
+        Book.objects.create(name="Book", author=Author.objects.create(name="Johnny"))
+        opened = []
+
+        def count(sender, connection, **kwargs):
+            opened.append(connection.alias)
+
+        connection_created.connect(count)
+        try:
+            queryset = Author.objects.prefetch('books', 'book_stats', 'latest_n_books_top', 'book_names')
+            self.assertEqual(len(list(queryset.prefetch_workers(2))), 1)
+        finally:
+            connection_created.disconnect(count)
+        # Every worker opens a connection, not every query.
+        self.assertLessEqual(len(opened), 2)
+
+    def test_prefetch_workers_invalid(self):
+        self.assertRaises(ValueError, Author.objects.prefetch('books').prefetch_workers, 0)
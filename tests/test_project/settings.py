@@ -17,6 +17,11 @@ DATABASES = {
         'NAME': SECONDARY_DATABASE_NAME
     }
 }
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
 INSTALLED_APPS = (
     'django.contrib.auth',
     'django.contrib.contenttypes',